@@ -0,0 +1,136 @@
+# compares the action extractors in grammar_parse (see LEAF_EXTRACTOR) on the benchmark corpus - how fast each one is,
+# and how often the nltk one agrees with spacy about the sentences the search looks ahead at
+# agreement is measured three ways: the same action structure, the same score, and - what actually matters to the search -
+# the same pick out of every word that can follow a sentence (the one with the best score)
+# run from the top folder with: python -m benchmarks.action_extractors [--corpus benchmarks/corpus.txt] [--sentences 200]
+import os
+import time
+import argparse
+import contextlib
+import numpy as np
+import story
+import story_util
+import grammar_parse
+from story_element import History
+from word_bank import WordBank
+
+corpus_path = os.path.join(os.path.dirname(__file__), "corpus.txt")
+
+# splits every line of the corpus into its sentences (lists of words)
+def read_sentences(path):
+    sentences = []
+    with open(path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            sentence = []
+            for word in line.split():
+                sentence.append(word)
+                if story_util.is_terminal_word(word):
+                    sentences.append(sentence)
+                    sentence = []
+    return sentences
+
+# the best time (in seconds per sentence) out of a few runs, parsing one sentence at a time and all of them in one batch
+def time_extractor(extractor, texts, repeats):
+    best_single = float('inf')
+    best_batch = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            extractor.parse([text])
+        best_single = min(best_single, time.perf_counter() - start)
+        start = time.perf_counter()
+        extractor.parse(texts)
+        best_batch = min(best_batch, time.perf_counter() - start)
+    return best_single / len(texts), best_batch / len(texts)
+
+# the rank correlation of two lists of scores (ties get the average of their ranks)
+def spearman(a, b):
+    def ranks(values):
+        values = np.array(values, dtype=np.float64)
+        order = np.argsort(values, kind='stable')
+        result = np.empty(len(values))
+        result[order] = np.arange(len(values))
+        for value in np.unique(values):
+            tied = values == value
+            result[tied] = result[tied].mean()
+        return result
+    ra, rb = ranks(a), ranks(b)
+    if ra.std() == 0 or rb.std() == 0:
+        return float('nan')
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+def score(words, history, structure):
+    return story.score_sentence(words, history, reject_incomplete=False, actions=grammar_parse.structure_to_actions(structure))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the spacy and nltk action extractors")
+    parser.add_argument("--corpus", default=corpus_path)
+    parser.add_argument("--sentences", type=int, default=200, help="how many sentences of the corpus to look ahead from")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    sentences = read_sentences(args.corpus)
+    with open(args.corpus, 'r', encoding='utf-8') as fp:
+        bank = WordBank.from_texts(fp.read().split('\n'), story.MARKOV_LENGTH)
+    spacy_extractor = grammar_parse.extractors['spacy']
+    nltk_extractor = grammar_parse.extractors['nltk']
+    try:
+        nltk_extractor.parse(["The king gave Tom a red apple."])
+    except LookupError as e:
+        print("The nltk tagger isn't installed:\n{}".format(e))
+        return
+    # loading the model isn't part of the timing
+    grammar_parse.get_nlp()
+
+    # the sentences the search would score partway through: every unfinished part of a corpus sentence, with each word that can follow it
+    # each group is one choice the search makes, so the same best sentence in a group means the same word would be picked
+    groups = []
+    for sentence in sentences[:args.sentences]:
+        for length in range(story.MARKOV_LENGTH, len(sentence)):
+            prefix = sentence[:length]
+            successors = bank.get(tuple(prefix[-story.MARKOV_LENGTH:]), {})
+            candidates = [prefix + [word] for word in successors if word is not None]
+            if len(candidates) > 1:
+                groups.append(candidates)
+    texts = list(dict.fromkeys(story.join_sentence(words) for group in groups for words in group))
+    print("{} sentences to score, in {} groups".format(len(texts), len(groups)))
+
+    for name, extractor in (("spacy", spacy_extractor), ("nltk", nltk_extractor)):
+        single, batch = time_extractor(extractor, texts, args.repeats)
+        print("{}: {:.3f} ms/sentence one at a time, {:.3f} ms/sentence in a batch".format(name, single * 1000, batch * 1000))
+
+    spacy_structures = dict(zip(texts, spacy_extractor.parse(texts)))
+    nltk_structures = dict(zip(texts, nltk_extractor.parse(texts)))
+    same_structures = sum(1 for text in texts if spacy_structures[text] == nltk_structures[text])
+    same_verbs = sum(1 for text in texts if sorted(action[0] for action in spacy_structures[text]) ==
+                     sorted(action[0] for action in nltk_structures[text]))
+
+    # the history the search scores against is the story so far - here it's the corpus sentences, parsed with spacy
+    history = History()
+    for i, sentence in enumerate(sentences[:args.sentences]):
+        for action in grammar_parse.structure_to_actions(spacy_extractor.parse([story.join_sentence(sentence)])[0]):
+            history.add_action(action, i)
+    spacy_scores = []
+    nltk_scores = []
+    same_picks = 0
+    # scoring prints every action which doesn't validate
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for group in groups:
+            group_spacy = [score(words, history, spacy_structures[story.join_sentence(words)]) for words in group]
+            group_nltk = [score(words, history, nltk_structures[story.join_sentence(words)]) for words in group]
+            spacy_best = {i for i, value in enumerate(group_spacy) if value == max(group_spacy)}
+            nltk_best = {i for i, value in enumerate(group_nltk) if value == max(group_nltk)}
+            # the search breaks ties at random, so any overlap means it could make the same pick
+            if len(spacy_best & nltk_best) > 0:
+                same_picks += 1
+            spacy_scores += group_spacy
+            nltk_scores += group_nltk
+    spacy_scores = np.array(spacy_scores)
+    nltk_scores = np.array(nltk_scores)
+    print("same action structure for {:.1%} of sentences, same verbs for {:.1%}".format(same_structures / len(texts), same_verbs / len(texts)))
+    print("same score for {:.1%} of sentences (mean difference {:.3f}), rank correlation {:.3f}".format(
+        float(np.mean(spacy_scores == nltk_scores)), float(np.mean(np.abs(spacy_scores - nltk_scores))), spearman(spacy_scores, nltk_scores)))
+    print("same pick in {:.1%} of {} choices".format(same_picks / len(groups), len(groups)))
+
+if __name__ == '__main__':
+    main()
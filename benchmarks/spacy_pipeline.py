@@ -0,0 +1,59 @@
+# how long the spacy model takes to load and to parse a sentence, with every pipe and with the pipes tobor leaves out (SPACY_EXCLUDED_PIPES)
+# also checks that both give the same action structures, so leaving the pipes out doesn't change any story
+# run from the top folder with: python -m benchmarks.spacy_pipeline
+import time
+import spacy
+import grammar_parse
+from story_constants import *
+
+sentences = [
+    "The old king gave the red crown to his daughter.",
+    "A big wolf saw the little girl in the dark forest.",
+    "The girl ran to the castle and the wolf ran after her.",
+    "Then the hunter took the bread from the wolf.",
+    "The daughter was happy and the king had a feast.",
+    "Sarah gave Tom a small green frog.",
+    "The bird found the crown and",
+    "The wolf ate the",
+    "Once upon a time there was a sad old miller.",
+    "The miller and his son walked to the village with a donkey.",
+]
+LOAD_REPEATS = 3
+PARSE_REPEATS = 20
+
+def time_load(exclude):
+    best = float('inf')
+    nlp = None
+    for _ in range(LOAD_REPEATS):
+        start = time.perf_counter()
+        nlp = spacy.load(SPACY_MODEL, exclude=exclude)
+        best = min(best, time.perf_counter() - start)
+    return nlp, best
+
+def time_parse(nlp):
+    best_single = float('inf')
+    best_pipe = float('inf')
+    for _ in range(PARSE_REPEATS):
+        start = time.perf_counter()
+        for sentence in sentences:
+            nlp(sentence)
+        best_single = min(best_single, time.perf_counter() - start)
+        start = time.perf_counter()
+        list(nlp.pipe(sentences))
+        best_pipe = min(best_pipe, time.perf_counter() - start)
+    return best_single / len(sentences), best_pipe / len(sentences)
+
+def main():
+    results = {}
+    for name, exclude in (("full", []), ("slim", SPACY_EXCLUDED_PIPES)):
+        nlp, load_time = time_load(exclude)
+        single, pipe = time_parse(nlp)
+        structures = [grammar_parse.parse_structure(nlp(sentence)) for sentence in sentences]
+        results[name] = structures
+        print("{}: pipes {}".format(name, nlp.pipe_names))
+        print("  load {:.3f} s, parse {:.3f} ms/sentence, pipe {:.3f} ms/sentence".format(load_time, single * 1000, pipe * 1000))
+    same = sum(1 for full, slim in zip(results["full"], results["slim"]) if full == slim)
+    print("same action structures for {}/{} sentences".format(same, len(sentences)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# how much it costs to turn a parse into story elements and actions and score them - once for every leaf of the lookahead
+# run from the top folder with: python -m benchmarks.story_elements
+import time
+import random
+import tracemalloc
+import story
+import grammar_parse
+from story_element import History
+
+# parse structures like the ones grammar_parse.parse_structure gives us, so spacy doesn't have to run
+structures = [
+    [("give", [("king", ["old"])], {"direct": [("crown", ["golden"])], "indirect": [("girl", ["little"])]})],
+    [("take", [("wolf", ["big", "bad"])], {"direct": [("bread", [])], "indirect": [("girl", [])]})],
+    [("run", [("girl", [])], {"direct": [], "indirect": [("forest", ["dark"])]}),
+     ("see", [("bird", ["red"])], {"direct": [("wolf", [])], "indirect": []})],
+    [("kill", [("hunter", [])], {"direct": [("wolf", [])], "indirect": []})],
+    [("eat", [("wolf", [])], {"direct": [("bread", []), ("cake", ["sweet"])], "indirect": []})],
+    [],
+]
+LEAF_COUNT = 20000
+REPEATS = 5
+
+def make_history():
+    history = History()
+    for t, structure in enumerate(structures * 3):
+        for action in grammar_parse.structure_to_actions(structure):
+            history.add_action(action, t)
+    return history
+
+def score_leaf(structure, history):
+    sentence = ["word"] * 12
+    actions = grammar_parse.structure_to_actions(structure)
+    return story.score_sentence(sentence, history, reject_incomplete=False, actions=actions), actions
+
+def main():
+    random.seed(0)
+    history = make_history()
+    leaves = [random.choice(structures) for _ in range(LEAF_COUNT)]
+
+    # time per leaf - the best of a few runs
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for structure in leaves:
+            score_leaf(structure, history)
+        best = min(best, time.perf_counter() - start)
+
+    # memory per leaf - everything scoring a leaf allocates, kept alive so we can count it
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    kept = [score_leaf(structure, history) for structure in leaves]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    element_count = sum(len(action.elements) for _, actions in kept for action in actions)
+
+    print("{} leaves ({} actions, {} elements)".format(len(leaves), sum(len(actions) for _, actions in kept), element_count))
+    print("time per leaf: {:.2f} us".format(best / len(leaves) * 1e6))
+    print("memory per leaf: {:.0f} bytes".format((after - before) / len(leaves)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# times story generation from a fixed corpus with a fixed seed, so the numbers can be compared between commits
+# every combination of story length and lookahead depth gets its own run, and the results are written out as json
+# run from the top folder with: python -m benchmarks.story_generation [--depths 1 2 3] [--lengths short medium] [--output results.json]
+# the same seed, corpus and spacy model always tell the same story - the digest of each story is in the results, so a change in it means the search changed
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import contextlib
+import argparse
+import platform
+import subprocess
+import numpy as np
+import story
+import grammar_parse
+import story_metrics
+from story_constants import *
+from story_element import History
+from word_bank import WordBank
+
+corpus_path = os.path.join(os.path.dirname(__file__), "corpus.txt")
+
+# builds a word bank the same way rebuilding one from the library does, treating every line of the corpus as one feed
+# it's packed (like the bank tobor loads at startup) rather than left pending, so lookups and word frequencies go through the arrays
+def build_bank(path, n):
+    with open(path, 'r', encoding='utf-8') as fp:
+        return WordBank.from_texts(fp.read().split('\n'), n)
+
+def percentiles(values):
+    if len(values) == 0:
+        return {}
+    return {"p50": float(np.percentile(values, 50)), "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)), "max": float(max(values))}
+
+def run(bank, length, depth, mode, seed):
+    random.seed(seed)
+    grammar_parse.parse_cache.clear()
+    grammar_parse.parse_cache.reset_stats()
+    stats = story_metrics.start_story(length, mode)
+    sentences = []
+    latencies = []
+    start = time.perf_counter()
+    last = start
+    # the story code prints every sentence (and every action that doesn't validate) - we only want the summary
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for sentence, score in story.generate_sentences(story.length_sentence_map[length], mode, bank, History(), depth):
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+            sentences.append(story.join_sentence(sentence))
+    wall_time = time.perf_counter() - start
+    story_metrics.finish_story()
+    text = ' '.join(sentences)
+    return {
+        "length": length,
+        "depth": depth,
+        "mode": mode,
+        "sentences": len(sentences),
+        "words": len(text.split()),
+        "wall_time": wall_time,
+        "sentence_latency": percentiles(latencies),
+        "nodes_expanded": stats.nodes_expanded,
+        "max_branching": stats.max_branching,
+        "leaves_scored": stats.leaves_scored,
+        "candidates_pruned": stats.candidates_pruned,
+        "parses": stats.parses,
+        "parse_time": stats.parse_time,
+        "sentences_truncated": stats.sentences_truncated,
+        "average_depth": stats.average_depth(),
+        "min_depth": stats.min_depth,
+        "deadline_hits": stats.deadline_hits,
+        "parse_cache": grammar_parse.parse_cache.stats(),
+        "story_digest": hashlib.sha1(text.encode('utf-8')).hexdigest()
+    }
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark story generation on a fixed corpus")
+    parser.add_argument("--lengths", nargs="+", default=["short", "medium", "long"], choices=list(story.length_sentence_map))
+    parser.add_argument("--depths", nargs="+", type=int, default=[1, 2, SEARCH_DEPTH])
+    # the 'anytime' search depends on how fast the machine is, so it can't be compared between runs the same way
+    parser.add_argument("--mode", default="exhaustive", choices=list(story.search_mode_map))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", default=corpus_path)
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args()
+
+    bank = build_bank(args.corpus, story.MARKOV_LENGTH)
+    # parses saved on disk by earlier runs (or by tobor) would make every run after the first look faster than it is
+    grammar_parse.parse_cache.store = None
+    # loading the model isn't part of any run
+    grammar_parse.get_nlp()
+    results = []
+    for depth in args.depths:
+        for length in args.lengths:
+            result = run(bank, length, depth, args.mode, args.seed)
+            latency = result["sentence_latency"]
+            print("{} story, depth {}: {:.2f} s, {} sentences, p50 {:.3f} s, p90 {:.3f} s, {} nodes, {} parses".format(
+                length, depth, result["wall_time"], result["sentences"], latency.get("p50", 0), latency.get("p90", 0),
+                result["nodes_expanded"], result["parses"]))
+            results.append(result)
+
+    output = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "markov_length": story.MARKOV_LENGTH,
+        "seed": args.seed,
+        "corpus": os.path.basename(args.corpus),
+        "corpus_keys": len(bank),
+        "runs": results
+    }
+    with open(args.output, 'w', encoding='utf-8') as fp:
+        json.dump(output, fp, indent=2)
+    print("Results written to {}".format(args.output))
+
+if __name__ == '__main__':
+    # python salts string hashes differently every run, which changes the order we look at words in - so we fix it
+    if os.environ.get("PYTHONHASHSEED") != "0":
+        os.execve(sys.executable, [sys.executable, "-m", "benchmarks.story_generation"] + sys.argv[1:], dict(os.environ, PYTHONHASHSEED="0"))
+    main()
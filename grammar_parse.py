@@ -1,13 +1,36 @@
+import re
+import abc
+import time
+import nltk
 import spacy
+import story_metrics
 from story_constants import *
 from story_element import *
+from parse_cache import ParseCache, ParseStore
 
-nlp = spacy.load("en_core_web_sm")
+# the spacy model takes a few seconds to load, so we don't load it until something actually needs to parse (see get_nlp)
+nlp = None
+
+# the parses saved on disk are thrown out if this changes - so it needs to go up whenever parse_structure gives different results
+STRUCTURE_VERSION = 1
+
+# remembers the action structure of every sentence we've parsed recently, keyed on the sentence text
+# (and every sentence we've parsed before, if PARSE_STORE_PATH is set)
+parse_store = None
+if PARSE_STORE_PATH is not None:
+    parse_store = ParseStore(PARSE_STORE_PATH, PARSE_STORE_SIZE, "{} {} {}".format(SPACY_MODEL, spacy.__version__, STRUCTURE_VERSION))
+parse_cache = ParseCache(PARSE_CACHE_SIZE, parse_store)
+
+def get_nlp():
+    global nlp
+    if nlp is None:
+        nlp = spacy.load(SPACY_MODEL, exclude=SPACY_EXCLUDED_PIPES)
+    return nlp
 
 # utility function which gets verbs from a sentence using spacy
 # not actually used directly by tobor
 def get_verbs(text):
-    doc = nlp(text)
+    doc = get_nlp()(text)
     verb_pos = {spacy.symbols.VERB, spacy.symbols.AUX}
     excluded_tags = {'WP'}
 
@@ -19,14 +42,91 @@ def get_verbs(text):
 
     return verbs
 
+# a way of turning sentences into action structures (see parse_structure) - tobor has one for spacy and a faster, rougher one for nltk
+# subclasses have to fill in parse (and can fill in record, so the work shows up in the search statistics)
+# each extractor keeps its own cache, since two extractors won't always agree about a sentence
+class ActionExtractor(abc.ABC):
+    def __init__(self, cache):
+        self.cache = cache
+
+    # takes a list of string sentences (none of them empty) and returns a list of their action structures
+    @abc.abstractmethod
+    def parse(self, sentences, batch_size=PARSE_BATCH_SIZE, n_process=PARSE_PROCESS_COUNT):
+        pass
+
+    def record(self, count, seconds):
+        pass
+
+    # takes a string sentence
+    # returns a list of actions, each action acting on elements within the story
+    # parsing is expensive, so we keep the structure of recently parsed sentences around and build fresh actions from it
+    def sentence_to_actions(self, sentence):
+        if sentence == '' or sentence == []:
+            return []
+        structure = self.cache.get(sentence)
+        if structure is None:
+            start = time.perf_counter()
+            structure = self.parse([sentence])[0]
+            self.record(1, time.perf_counter() - start)
+            self.cache.put(sentence, structure)
+        return structure_to_actions(structure)
+
+    # takes a list of string sentences and parses all of the ones we haven't seen before in one go
+    # returns a dict mapping each sentence to its action structure (these also go into the cache)
+    def parse_batch(self, sentences, batch_size=PARSE_BATCH_SIZE, n_process=PARSE_PROCESS_COUNT):
+        structures = {}
+        to_parse = []
+        for sentence in sentences:
+            if sentence in structures:
+                continue
+            if sentence == '':
+                structures[sentence] = []
+                continue
+            structure = self.cache.get(sentence)
+            if structure is None:
+                # we mark the sentence so a duplicate later in the list doesn't get parsed twice
+                structures[sentence] = None
+                to_parse.append(sentence)
+            else:
+                structures[sentence] = structure
+        if len(to_parse) > 0:
+            start = time.perf_counter()
+            for sentence, structure in zip(to_parse, self.parse(to_parse, batch_size, n_process)):
+                self.cache.put(sentence, structure)
+                structures[sentence] = structure
+            self.record(len(to_parse), time.perf_counter() - start)
+        return structures
+
+# the full dependency parse - this is what every finished sentence is scored with, and what the history is built from
+class SpacyExtractor(ActionExtractor):
+    # nlp.pipe is a lot faster than calling nlp once per sentence, since spacy can batch the work up
+    def parse(self, sentences, batch_size=PARSE_BATCH_SIZE, n_process=PARSE_PROCESS_COUNT):
+        if len(sentences) == 1:
+            return [parse_structure(get_nlp()(sentences[0]))]
+        return [parse_structure(doc) for doc in get_nlp().pipe(sentences, batch_size=batch_size, n_process=n_process)]
+
+    def record(self, count, seconds):
+        story_metrics.current.parsed(count, seconds)
+
 # takes a string sentence
 # returns a list of actions, each action acting on elements within the story
-# this has to handle incomplete sentences due to sentence generation, which makes it a little messy
 def sentence_to_actions(sentence, should_render=False):
     if sentence == '' or sentence == []:
         return []
-    doc = nlp(sentence)
+    if should_render:
+        return structure_to_actions(parse_structure(get_nlp()(sentence), should_render))
+    return spacy_extractor.sentence_to_actions(sentence)
+
+# takes a list of string sentences and parses all of the ones we haven't seen before with spacy in one go
+# returns a dict mapping each sentence to its action structure (these also go into the cache)
+def parse_batch(sentences, batch_size=PARSE_BATCH_SIZE, n_process=PARSE_PROCESS_COUNT):
+    return spacy_extractor.parse_batch(sentences, batch_size, n_process)
 
+# takes a spacy doc
+# returns a list of action structures - (verb, subjects, objects), where each subject/object is a (name, descriptors) pair
+# the structure only holds plain strings, so it's safe to cache and reuse (the story elements we build from it are not)
+# this has to handle incomplete sentences due to sentence generation, which makes it a little messy
+def parse_structure(doc, should_render=False):
     if should_render:
         render = spacy.displacy.render(doc)
         with open('./render.html', 'w', encoding='utf-8') as fp:
@@ -94,14 +194,14 @@ def sentence_to_actions(sentence, should_render=False):
         while noun_head.pos not in noun_pos and noun_head.dep_ != "ROOT":
             noun_head = noun_head.head
         if noun_head in noun_dicts:
-            noun_dicts[noun_head].append(adjective)
+            noun_dicts[noun_head].append(adjective.lower_)
 
     for subject in subjects:
         verb_head = subject.head
         while verb_head.pos not in verb_pos and verb_head.dep_ != "ROOT":
             verb_head = verb_head.head
         if verb_head in action_dicts:
-            action_dicts[verb_head]["subjects"].append((subject, noun_dicts[subject]))
+            action_dicts[verb_head]["subjects"].append((subject.lower_, noun_dicts[subject]))
 
     for o in objects:
         verb_head = o.head
@@ -115,20 +215,23 @@ def sentence_to_actions(sentence, should_render=False):
                 # this is conjugate, so might be either category
                 if o.head.dep == spacy.symbols.dobj:
                     category = 'direct'
-            action_dicts[verb_head]["objects"][category].append((o, noun_dicts[o]))
-
+            action_dicts[verb_head]["objects"][category].append((o.lower_, noun_dicts[o]))
 
+    return [(verb.lemma_, nouns["subjects"], nouns["objects"]) for verb, nouns in action_dicts.items()]
 
+# takes a list of action structures (see parse_structure)
+# returns a list of brand new actions - every call gives new story elements, so they can be changed without touching the cache
+def structure_to_actions(structure):
     actions = []
-    for verb, nouns in action_dicts.items():
+    for verb, subjects, objects in structure:
         act_subj = []
-        for noun, descriptors in nouns["subjects"]:
+        for noun, descriptors in subjects:
             act_subj.append(StoryElement(noun, descriptors=descriptors))
         act_obj = { "direct": [], "indirect": [] }
-        for object_type in nouns["objects"]:
-            for noun, descriptors in nouns["objects"][object_type]:
+        for object_type in objects:
+            for noun, descriptors in objects[object_type]:
                 act_obj[object_type].append((StoryElement(noun, descriptors=descriptors)))
-        action = build_action(verb.lemma_, act_subj, act_obj)
+        action = build_action(verb, act_subj, act_obj)
         actions.append(action)
     return actions
 
@@ -149,3 +252,168 @@ def build_action(verb, subjects, objects):
     else:
         return Action(*args)
 
+
+# the tags nltk's tagger gives words (penn treebank tags) which we care about
+NLTK_PREPOSITION_TAGS = {'IN', 'TO'}
+NLTK_CLAUSE_END_TAGS = {'.', ':'}
+# noun phrases (an optional possessive, then determiners, adjectives and nouns - or just a pronoun) and verb groups ('did not want to ask')
+NLTK_CHUNK_GRAMMAR = r"""
+NP: {<DT|PRP\$|CD>*<JJ.*>*(<NN.*>+<POS>)?<JJ.*>*<NN.*>+}
+    {<PRP>}
+VP: {<MD|VB.*>(<RB>*<TO>?<MD|VB.*>)*}
+"""
+# the past tenses nltk can't help us with - spacy gives the lemma of a verb, so we need to as well
+IRREGULAR_VERBS = {
+    "was": "be", "were": "be", "is": "be", "are": "be", "am": "be", "been": "be",
+    "has": "have", "had": "have", "did": "do", "does": "do", "done": "do",
+    "gave": "give", "given": "give", "took": "take", "taken": "take", "got": "get", "gotten": "get",
+    "ran": "run", "went": "go", "gone": "go", "came": "come", "flew": "fly", "flown": "fly", "rode": "ride", "ridden": "ride",
+    "drove": "drive", "driven": "drive", "swam": "swim", "crept": "creep", "leapt": "leap", "fled": "flee", "fell": "fall",
+    "threw": "throw", "thrown": "throw", "ate": "eat", "eaten": "eat", "broke": "break", "broken": "break",
+    "tore": "tear", "torn": "tear", "stole": "steal", "stolen": "steal", "bought": "buy", "sold": "sell", "brought": "bring",
+    "caught": "catch", "held": "hold", "left": "leave", "lost": "lose", "bound": "bind", "hid": "hide", "hidden": "hide",
+    "saw": "see", "seen": "see", "found": "find", "made": "make", "told": "tell", "said": "say", "knew": "know",
+    "thought": "think", "sat": "sit", "stood": "stand", "slept": "sleep", "felt": "feel", "heard": "hear", "met": "meet",
+    "kept": "keep", "began": "begin", "woke": "wake", "drank": "drink", "sang": "sing", "won": "win", "spoke": "speak",
+    "wore": "wear", "fed": "feed", "led": "lead", "dug": "dig", "hung": "hang", "struck": "strike", "slid": "slide"
+}
+AUXILIARY_VERBS = {"be", "have", "do"}
+# the verbs we know the plain form of, for putting back an 'e' we took off (moved -> move, not mov)
+KNOWN_VERBS = set(VERB_ROOT_MAP) | set(VERB_ROOT_MAP.values()) | set(IRREGULAR_VERBS.values())
+
+# a rough guess at the lemma of a verb from its spelling - good enough to tell a 'give' from a 'take'
+def lemmatize_verb(word, tag):
+    word = word.lower()
+    if word in IRREGULAR_VERBS:
+        return IRREGULAR_VERBS[word]
+    if tag == 'VBZ' and word.endswith('s'):
+        if word.endswith('ies'):
+            return word[:-3] + 'y'
+        if word.endswith('es') and word[:-2] in KNOWN_VERBS:
+            # pushes -> push
+            return word[:-2]
+        return word[:-1]
+    for ending in ('ed', 'ing'):
+        if not word.endswith(ending) or len(word) <= len(ending) + 1:
+            continue
+        if word.endswith('ied'):
+            return word[:-3] + 'y'
+        stem = word[:-len(ending)]
+        if stem in KNOWN_VERBS:
+            return stem
+        if stem + 'e' in KNOWN_VERBS:
+            return stem + 'e'
+        if len(stem) > 2 and stem[-1] == stem[-2] and stem[-1] not in 'lsz':
+            # stopped, running
+            return stem[:-1]
+        return stem
+    return word
+
+# the best guess at an action structure (the same shape parse_structure gives) from a part of speech tagger and a chunker
+# there's no dependency parse, so subjects are the noun phrases just before a verb, and objects are the ones after it
+# it doesn't get everything spacy does, but it's many times faster - which is what the search wants for the sentences it's only looking ahead at
+class NltkExtractor(ActionExtractor):
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.chunker = nltk.RegexpParser(NLTK_CHUNK_GRAMMAR)
+
+    @staticmethod
+    def tokenize(sentence):
+        # splits off punctuation and possessives the way the tagger was trained ('king's.' -> king 's .)
+        return re.findall(r"\w+|'\w*|[^\w\s]", sentence)
+
+    def parse(self, sentences, batch_size=PARSE_BATCH_SIZE, n_process=PARSE_PROCESS_COUNT):
+        tagged_sentences = nltk.pos_tag_sents([NltkExtractor.tokenize(sentence) for sentence in sentences])
+        return [self.chunk_structure(tagged) if len(tagged) > 0 else [] for tagged in tagged_sentences]
+
+    def record(self, count, seconds):
+        story_metrics.current.tagged(count, seconds)
+
+    def chunk_structure(self, tagged):
+        actions = []
+        current = None
+        # noun phrases since the last verb, with the tag of whatever came just before each one
+        nouns = []
+        previous = None
+        for node in self.chunker.parse(tagged):
+            label = node.label() if isinstance(node, nltk.Tree) else node[1]
+            if label == 'NP':
+                nouns.append((noun_phrase(node.leaves()), previous))
+            elif label == 'VP':
+                # the noun phrase right before the verb (and any joined to it with 'and') is its subject
+                # everything before that belongs to the verb before
+                split = len(nouns)
+                if previous == 'NP':
+                    split -= 1
+                    while split > 0 and nouns[split][1] == 'CC':
+                        split -= 1
+                    subjects = [noun for noun, _ in nouns[split:]]
+                elif previous == 'CC' and current is not None:
+                    # 'took the crown and ran' - the same subject again
+                    subjects = current[1]
+                else:
+                    subjects = []
+                if current is not None:
+                    add_objects(current, nouns[:split])
+                current = (verb_head(node.leaves()), subjects, { "direct": [], "indirect": [] })
+                # spacy only finds the verbs which have a subject
+                if len(subjects) > 0:
+                    actions.append(current)
+                nouns = []
+            elif label in NLTK_CLAUSE_END_TAGS:
+                if current is not None:
+                    add_objects(current, nouns)
+                current = None
+                nouns = []
+            if label != 'RB':
+                previous = label
+        if current is not None:
+            add_objects(current, nouns)
+        return actions
+
+# the (name, descriptors) of a noun phrase - the last noun (or pronoun), and its adjectives
+def noun_phrase(leaves):
+    if leaves[-1][1] == 'PRP':
+        return leaves[-1][0].lower(), []
+    possessive = max([i for i, (_, tag) in enumerate(leaves) if tag == 'POS'], default=-1)
+    head = [word for word, tag in leaves if tag.startswith('NN')][-1]
+    return head.lower(), [word.lower() for word, tag in leaves[possessive + 1:] if tag.startswith('JJ')]
+
+# the verb in a verb group which the subject goes with - 'was walking' is walking, 'did not want to ask' is want, and 'was happy' is be
+def verb_head(leaves):
+    verbs = [(word, tag) for word, tag in leaves if tag.startswith('VB')]
+    if len(verbs) == 0:
+        # only a modal ('could')
+        return leaves[-1][0].lower()
+    for i, (word, tag) in enumerate(verbs):
+        lemma = lemmatize_verb(word, tag)
+        if lemma not in AUXILIARY_VERBS or i == len(verbs) - 1:
+            return lemma
+
+# sorts the noun phrases after a verb into its direct and indirect objects
+# after a preposition is indirect, straight after the verb is direct - unless another one follows it ('gave Tom an apple'), which makes the first one indirect
+def add_objects(action, nouns):
+    objects = action[2]
+    category = None
+    for noun, previous in nouns:
+        if previous in NLTK_PREPOSITION_TAGS:
+            category = 'indirect'
+        elif previous == 'CC' and category is not None:
+            pass
+        else:
+            if previous == 'NP' and category == 'direct':
+                objects['indirect'].append(objects['direct'].pop())
+            category = 'direct'
+        objects[category].append(noun)
+
+# the extractors tobor can use, by name (see LEAF_EXTRACTOR)
+spacy_extractor = SpacyExtractor(parse_cache)
+extractors = {
+    'spacy': spacy_extractor,
+    'nltk': NltkExtractor(ParseCache(PARSE_CACHE_SIZE))
+}
+
+# finished sentences (reject_incomplete) are always scored with spacy, since that's what the history is built from
+# the ones the search is only looking ahead at use LEAF_EXTRACTOR
+def get_extractor(reject_incomplete):
+    return spacy_extractor if reject_incomplete else extractors[LEAF_EXTRACTOR]
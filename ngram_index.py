@@ -0,0 +1,143 @@
+import bisect
+import random
+import numpy as np
+from story_constants import *
+from word_bank import is_start_key
+
+# an index over everything tobor has been fed which can answer 'what follows these words?' for any number of words
+# this means stories can use any chain length (up to MAX_CHAIN_LENGTH) without building a new word bank for it
+# the whole corpus is one array of word ids, with id 0 (None) marking the end of each text, like get_word_combos does
+# the suffix array holds every position in the corpus, sorted by the words starting there - so every occurrence of a
+# sequence of words is in one block of it, which we can find with a binary search
+class NGramIndex:
+    def __init__(self, texts):
+        self.vocab = [None]
+        word_ids = {None: 0}
+        corpus = []
+        for text in texts:
+            words = text.split()
+            if len(words) == 0:
+                continue
+            corpus += [word_ids.setdefault(word, len(word_ids)) for word in words]
+            corpus.append(0)
+        self.vocab += list(word_ids.keys())[1:]
+        self.word_ids = word_ids
+        # the padding at the end means we can always read MAX_CHAIN_LENGTH + 1 words from any position
+        self.corpus = np.array(corpus + [0] * (MAX_CHAIN_LENGTH + 1), dtype=np.int32)
+        self.size = len(corpus)
+        # sort positions by the next MAX_CHAIN_LENGTH + 1 words - enough for the longest key and the word after it
+        columns = [self.corpus[i:i + self.size] for i in range(MAX_CHAIN_LENGTH, -1, -1)]
+        self.suffixes = np.lexsort(columns).astype(np.int64) if self.size > 0 else np.zeros(0, dtype=np.int64)
+        # the positions which could start a story - a capitalised word
+        start_words = np.array([False] + [is_start_key((word,)) for word in self.vocab[1:]])
+        self.start_positions = np.flatnonzero(start_words[self.corpus[:self.size]])
+        # how many times each word shows up (see WordBank.word_frequency)
+        self.word_totals = np.bincount(self.corpus[:self.size], minlength=len(self.vocab))
+
+    @staticmethod
+    def from_file(path):
+        with open(path, 'r', encoding='utf-8') as fp:
+            # every feed is written to its own line (see feed_generator)
+            return NGramIndex(fp.read().split('\n'))
+
+    def words_at(self, position, length):
+        return tuple(self.corpus[position:position + length].tolist())
+
+    # returns a dict of the words which follow exactly this sequence of words and how often they do - empty if it never shows up
+    def successors(self, key):
+        ids = []
+        for word in key:
+            if word not in self.word_ids:
+                return {}
+            ids.append(self.word_ids[word])
+        ids = tuple(ids)
+        length = len(ids)
+
+        def prefix(i):
+            return self.words_at(int(self.suffixes[i]), length)
+
+        positions = range(len(self.suffixes))
+        low = bisect.bisect_left(positions, ids, key=prefix)
+        high = bisect.bisect_right(positions, ids, key=prefix)
+        if low == high:
+            return {}
+        following = self.corpus[self.suffixes[low:high] + length]
+        word_ids, counts = np.unique(following, return_counts=True)
+        return {self.vocab[word_id]: count for word_id, count in zip(word_ids.tolist(), counts.tolist())}
+
+    # like successors, but if the key never shows up we keep dropping its first word until we find something that follows
+    # returns an empty dict only if not even the last word has ever been followed by anything
+    def backoff_successors(self, key):
+        if None in key:
+            # the end of a text - nothing follows it (same as the word bank), and nothing before it matters to what comes after
+            if key[-1] is None:
+                return {None: 1}
+            key = key[len(key) - key[::-1].index(None):]
+        while len(key) > 0:
+            successors = self.successors(key)
+            if len(successors) > 0:
+                return successors
+            key = key[1:]
+        return {}
+
+    # same as WordBank.word_frequency
+    def word_frequency(self, word):
+        count = self.word_totals[self.word_ids[word]] if word in self.word_ids else 0
+        return (count + 1) / (self.size + len(self.vocab))
+
+    def view(self, order):
+        return NGramView(self, order)
+
+# looks like a word bank with keys of length 'order' (see WordBank), so the story code can use any chain length
+# a key that was never seen backs off to its shorter endings
+class NGramView:
+    def __init__(self, index, order):
+        if order < 1 or order > MAX_CHAIN_LENGTH:
+            raise ValueError("Chain length must be between 1 and {}".format(MAX_CHAIN_LENGTH))
+        self.index = index
+        self.n = order
+        # lookahead asks about the same keys over and over
+        self.cache = {}
+
+    def get(self, key, default=None):
+        if key not in self.cache:
+            if len(self.cache) >= ALIAS_TABLE_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = self.index.backoff_successors(key)
+        successors = self.cache[key]
+        return successors if len(successors) > 0 else default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        successors = self.get(key)
+        if successors is None:
+            raise KeyError(key)
+        return successors
+
+    def __len__(self):
+        return self.index.size
+
+    def sample_successors(self, key, count):
+        successors = self.get(key, {})
+        if len(successors) == 0:
+            return []
+        words = random.choices(list(successors.keys()), weights=list(successors.values()), k=count)
+        return list(dict.fromkeys(words))
+
+    def word_frequency(self, word):
+        return self.index.word_frequency(word)
+
+    # picks the words at a random capitalised position in the corpus
+    # every key is picked in proportion to how often it shows up, whether or not weighted is set
+    def random_start_key(self, weighted=False):
+        if len(self.index.start_positions) == 0:
+            return None
+        for _ in range(100):
+            position = int(random.choice(self.index.start_positions))
+            key = self.index.words_at(position, self.n)
+            # the key can't run past the end of its text
+            if 0 not in key:
+                return tuple(self.index.vocab[word_id] for word_id in key)
+        return None
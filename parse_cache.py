@@ -0,0 +1,181 @@
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+
+# a bounded least-recently-used cache for sentence parses
+# lookahead re-parses the same sentence prefixes over and over, so we remember what spacy told us about them
+# the cache keeps track of how often it saved us a parse (hits), how often it didn't (misses) and how often it had to forget something (evictions)
+# if it's given a store (see ParseStore), anything it doesn't have is looked up there too, and everything put in it is also saved there
+# store_hits counts the misses the store had an answer for
+class ParseCache:
+    def __init__(self, max_size, store=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.store_hits = 0
+
+    def __contains__(self, text):
+        return text in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # returns the cached value for the text, or None if we haven't seen it (or have forgotten it)
+    def get(self, text):
+        if text not in self.entries:
+            self.misses += 1
+            value = self.store.get(text) if self.store is not None else None
+            if value is not None:
+                self.store_hits += 1
+                self.remember(text, value)
+            return value
+        self.hits += 1
+        # this text was just used, so it goes to the back of the eviction line
+        self.entries.move_to_end(text)
+        if self.store is not None:
+            self.store.touch(text)
+        return self.entries[text]
+
+    def put(self, text, value):
+        self.remember(text, value)
+        if self.store is not None:
+            self.store.put(text, value)
+
+    def remember(self, text, value):
+        if text in self.entries:
+            self.entries.move_to_end(text)
+        self.entries[text] = value
+        while len(self.entries) > self.max_size:
+            # the first entry is the one we used least recently
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # only clears what's in memory - the store is left alone
+    def clear(self):
+        self.entries.clear()
+
+    # makes sure everything we've put in the cache is in the store
+    def flush(self):
+        if self.store is not None:
+            self.store.flush()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.store_hits = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "store_hits": self.store_hits,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0
+        }
+
+    def __str__(self):
+        stats = self.stats()
+        summary = "{} hits, {} misses ({:.1%} hit rate), {} evictions, {}/{} entries".format(
+            stats["hits"], stats["misses"], stats["hit_rate"], stats["evictions"], stats["size"], stats["max_size"])
+        if self.store is not None:
+            summary += ", {} misses found on disk".format(stats["store_hits"])
+        return summary
+
+# parses kept in a sqlite file, so they survive tobor restarting - the same sentence fragments come up story after story
+# each row is the sentence (with its spacing normalised), its parse as json, and when it was last used
+# once there are more than max_size rows, the ones used least recently are deleted
+# new parses (and which parses were used) are only written when flush is called (once a story is finished), so the search isn't waiting on the disk
+# the story workers all share the same file - sqlite takes care of them not writing at the same time
+# a parse depends on the spacy model (and our own code), so if version doesn't match the one the file was made with, we start over
+class ParseStore:
+    def __init__(self, path, max_size, version):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        # opened the first time we need it - a connection can't be shared with another process
+        self.connection = None
+        # about how many rows the file has - counted when we connect, then we add the ones we write
+        # it can only be too high (a row we write might already be there), so we count again properly before deleting anything
+        self.row_count = 0
+        # text -> json for parses we haven't written yet, and texts whose last_used we haven't updated yet
+        # the used texts aren't normalised until they're written, so marking one is as cheap as possible
+        self.new_entries = {}
+        self.used = set()
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            # write-ahead logging lets the other processes keep reading while one of them writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS parses (text TEXT PRIMARY KEY, structure TEXT, last_used REAL)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS parses_last_used ON parses (last_used)")
+                row = self.connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+                if row is None or row[0] != self.version:
+                    self.connection.execute("DELETE FROM parses")
+                    self.connection.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)", (self.version,))
+                self.row_count = self.connection.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+        return self.connection
+
+    @staticmethod
+    def normalise(text):
+        return ' '.join(text.split())
+
+    def get(self, text):
+        text = ParseStore.normalise(text)
+        if text in self.new_entries:
+            return json.loads(self.new_entries[text])
+        row = self.connect().execute("SELECT structure FROM parses WHERE text = ?", (text,)).fetchone()
+        if row is None:
+            return None
+        self.touch(text)
+        return json.loads(row[0])
+
+    # marks the parse as used just now, so it isn't the next one to be deleted
+    # this happens on every cache hit, so it only remembers the text until the next flush
+    def touch(self, text):
+        self.used.add(text)
+
+    def put(self, text, value):
+        self.new_entries[ParseStore.normalise(text)] = json.dumps(value, separators=(',', ':'))
+
+    def flush(self):
+        if len(self.new_entries) == 0 and len(self.used) == 0:
+            return
+        now = time.time()
+        connection = self.connect()
+        used = {ParseStore.normalise(text) for text in self.used}.difference(self.new_entries)
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO parses VALUES (?, ?, ?)",
+                                   [(text, structure, now) for text, structure in self.new_entries.items()])
+            connection.executemany("UPDATE parses SET last_used = ? WHERE text = ?", [(now, text) for text in used])
+            self.row_count += len(self.new_entries)
+            if self.row_count > self.max_size:
+                # the other workers write to the same file, so this is the only way to know for sure
+                self.row_count = connection.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+                excess = self.row_count - self.max_size
+                if excess > 0:
+                    connection.execute("DELETE FROM parses WHERE text IN (SELECT text FROM parses ORDER BY last_used LIMIT ?)", (excess,))
+                    self.row_count = self.max_size
+        self.new_entries = {}
+        self.used = set()
+
+    def __len__(self):
+        self.flush()
+        return self.connect().execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
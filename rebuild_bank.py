@@ -0,0 +1,77 @@
+# builds a fresh word bank from everything tobor has ever been fed (story-data.txt), for any chain length
+# the library is split into shards which are counted in parallel, then the counts are added together (see word_bank.count_ngrams)
+# every line of the library is counted as its own feed, the same as the n-gram index does (see story.FeedStream.add_words)
+# tobor shouldn't be running while this does - it replaces the bank file and empties the journal for that chain length
+# usage: python rebuild_bank.py [--length 3] [--workers 8] [--library story-data.txt] [--output tobor-bank-3.bin]
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from word_bank import WordBank, BankJournal, count_ngrams, merge_ngram_counts, latest_bank
+
+SHARDS_PER_WORKER = 4
+
+# splits the file into about shard_count (start, end) byte ranges - each one starts at the beginning of a line and ends just after one
+def find_shards(path, shard_count):
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as fp:
+        for i in range(1, shard_count):
+            fp.seek(max(size * i // shard_count, boundaries[-1]))
+            # we finish the line we landed in, so the next shard starts on a new one
+            fp.readline()
+            position = fp.tell()
+            if position >= size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+# this runs in a worker - counts the word combos of every line in one shard
+def count_shard(path, start, end, n):
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    return count_ngrams(data.decode('utf-8').split('\n'), n)
+
+def rebuild(library, n, output, workers):
+    started = time.perf_counter()
+    shards = find_shards(library, workers * SHARDS_PER_WORKER)
+    print("Counting {} in {} shards on {} workers".format(library, len(shards), workers))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [executor.submit(count_shard, library, start, end, n) for start, end in shards]
+        tables = [future.result() for future in futures]
+    counted = time.perf_counter()
+    bank = WordBank.from_ngram_counts(merge_ngram_counts(tables, n), n)
+    print("Counted in {:.1f} s, merged in {:.1f} s - {} keys, {} words".format(
+        counted - started, time.perf_counter() - counted, len(bank), len(bank.vocab) - 1))
+
+    # the journal only holds feeds which are already in the library, so the new bank includes all of them
+    # we read it through anyway so the sequence numbers carry on from where the old bank and journal left off
+    journal = BankJournal(os.path.splitext(output)[0] + '.journal')
+    old_path = latest_bank(output)
+    journal_seq = WordBank.open(old_path).journal_seq if old_path is not None else 0
+    journal.replay(WordBank(n, journal_seq=journal_seq))
+    journal.compact(bank, output, force=True)
+    print("Saved {} in {:.1f} s total".format(latest_bank(output), time.perf_counter() - started))
+    return bank
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild tobor's word bank from everything he has been fed")
+    parser.add_argument("--length", type=int, default=3, help="the chain length (MARKOV_LENGTH) to build the bank for")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="how many processes count the shards")
+    parser.add_argument("--library", default="story-data.txt")
+    parser.add_argument("--output", default=None, help="where to save the bank (tobor-bank-<length>.bin by default - it's saved as the next numbered file after that name)")
+    args = parser.parse_args()
+    if args.length < 1:
+        parser.error("the chain length has to be at least 1")
+    if not os.path.exists(args.library):
+        parser.error("{} doesn't exist".format(args.library))
+    output = args.output if args.output is not None else "tobor-bank-{}.bin".format(args.length)
+    rebuild(args.library, args.length, output, max(args.workers, 1))
+
+if __name__ == '__main__':
+    main()
@@ -1,94 +1,262 @@
 import os
+import math
+import time
 import util
+import codecs
+import shutil
+import tempfile
+import threading
 import random
 import story_util
 import grammar_parse
+import story_metrics
 from story_constants import *
 from story_element import History
+from word_bank import WordBank, BankJournal, latest_bank
+from ngram_index import NGramIndex
 
 babel_library = "story-data.txt"
 MARKOV_LENGTH = 3
-babel_store = f"tobor-dict-{MARKOV_LENGTH}.pkl"
+# each save goes to a new numbered file next to this name (see word_bank.latest_bank)
+babel_store = f"tobor-bank-{MARKOV_LENGTH}.bin"
+# the word bank used to be a pickled dict of dicts - if that's all we have, we convert it
+legacy_babel_store = f"tobor-dict-{MARKOV_LENGTH}.pkl"
+# everything fed since the bank was last saved - see BankJournal
+babel_journal = f"tobor-bank-{MARKOV_LENGTH}.journal"
 
-word_bank = {}
+word_bank = WordBank(MARKOV_LENGTH)
+journal = BankJournal(babel_journal)
+# answers lookups for chain lengths other than MARKOV_LENGTH - built from babel_library the first time a story needs it
+ngram_index = None
 length_sentence_map = {
     'short': SHORT_STORY_SENT_COUNT,
     'medium': MED_STORY_SENT_COUNT,
     'long': LONG_STORY_SENT_COUNT
 }
 
-def init():
+# read_only is for processes which only tell stories (the story workers) - they never write to the journal
+def init(read_only=False):
     global word_bank
-    if os.path.exists(babel_store):
-        word_bank = util.read_data(babel_store)
+    # init can run more than once (discord calls on_ready again after every reconnect), so we always start from what's on disk -
+    # the bank we already have holds the journal's feeds, and replaying them on top of it would count them twice
+    # a feed (e.g. a file still being eaten on another thread) could otherwise add to the old bank after we've swapped it out,
+    # or compact the journal while we're reading it
+    with feed_lock:
+        bank_path = latest_bank(babel_store)
+        if bank_path is not None:
+            # this doesn't actually read the bank - it's memory mapped, so the pages are loaded as stories need them (and shared between workers)
+            bank = WordBank.open(bank_path)
+        elif os.path.exists(legacy_babel_store):
+            bank = migrate_bank(legacy_babel_store, babel_store)
+        else:
+            bank = WordBank(MARKOV_LENGTH)
+        # then we catch up on everything tobor was fed after the bank was last saved
+        applied = journal.replay(bank)
+        word_bank = bank
+        if not read_only:
+            journal.repair()
+    if applied > 0:
+        print("Replayed {} feeds from {}".format(applied, babel_journal))
+
+# saves everything in the journal into the bank file and empties the journal
+def compact_bank():
+    journal.compact(word_bank, babel_store)
+
+# converts a pickled dict of dicts word bank into the compact format, saves it, and returns it
+# the old file is left where it is
+def migrate_bank(legacy_path, path):
+    print("Converting word bank {} to {}".format(legacy_path, path))
+    bank = WordBank.from_dict(util.read_data(legacy_path), MARKOV_LENGTH)
+    bank.save(path)
+    return bank
+
+# returns something that works like the word bank for the given chain length (the word bank itself if it's MARKOV_LENGTH)
+def get_chain(order=None):
+    global ngram_index
+    if order is None or order == MARKOV_LENGTH:
+        return word_bank
+    if ngram_index is None:
+        print("Building the n-gram index from {}".format(babel_library))
+        ngram_index = NGramIndex.from_file(babel_library) if os.path.exists(babel_library) else NGramIndex([])
+    return ngram_index.view(order)
 
-def generate_story(length, chunk_size):
+# order is the chain length to use for this story - by default, the word bank's
+def generate_story(length, chunk_size, mode=DEFAULT_SEARCH_MODE, order=None):
+    story_metrics.start_story(length, mode)
     length = length_sentence_map[length]
-    story, score, history = generate_story_of_length(length)
+    grammar_parse.parse_cache.reset_stats()
+    story, score, history = generate_story_of_length(length, mode, get_chain(order))
+    grammar_parse.parse_cache.flush()
+    print("Parse cache: {}".format(grammar_parse.parse_cache))
+    print("Search: {}".format(story_metrics.finish_story()))
     return chunk_story(story.split(), chunk_size)
 
+# what tobor says instead of a story when nothing he's been fed could start one
+NO_DATA = "No data"
+
+# like generate_story, but each sentence is handed to send (as text) as soon as it's finished instead of waiting for the whole story
+# sends NO_DATA if there's no story to tell
+# returns the search statistics for the story (see story_metrics)
+def stream_story(length, send, mode=DEFAULT_SEARCH_MODE, order=None):
+    stats = story_metrics.start_story(length, mode)
+    length = length_sentence_map[length]
+    grammar_parse.parse_cache.reset_stats()
+    sent_any = False
+    for sentence, score in generate_sentences(length, mode, get_chain(order)):
+        text = join_sentence(sentence)
+        if len(text) > 0:
+            send(text)
+            sent_any = True
+    if not sent_any:
+        send(NO_DATA)
+    grammar_parse.parse_cache.flush()
+    print("Parse cache: {}".format(grammar_parse.parse_cache))
+    print("Search: {}".format(story_metrics.finish_story()))
+    return stats
+
+# joins a (possibly unfinished) sentence into the text we give to the parser
+def join_sentence(sentence):
+    return ' '.join([x for x in sentence if x is not None])
+
 # takes as input a list of actions, the history, and a bool indicating whether to penalize incomplete actions
 # returns a tuple fits_history, novel_elements
 # misfits_history is an integer measure of the number of actions/elements which disagree with history/rules
 # novel_elements is an integer measure of the number of new elements not in history
+# each action's elements are first mapped onto the ones already in the history, so it's checked against what they've been through
+# and every action but the last is tried out on the history, so the ones after it are checked against it too
+# (apart from ones with nothing to act on - e.g. a give with no objects - which wouldn't change anything)
+# the history is rolled back afterwards - the sentence is only being scored, not told
 def score_actions(actions, history, reject_incomplete):
     misfits_history = 0
     novel_elements = 0
-    for action in actions:
-        valid_action = action.validate(reject_incomplete)
-        if not valid_action:
-            print("Action '{}' failed to validate".format(action))
-            misfits_history += 1
-        for action_element in action.elements:
-            if not history.contains_element(action_element):
-                novel_elements += 1
+    t = history.actions[-1].t + 1 if len(history.actions) > 0 else 0
+    snapshot = history.snapshot()
+    try:
+        for i, action in enumerate(actions):
+            action = history.map_elements(action)
+            valid_action = action.validate(reject_incomplete)
+            if not valid_action:
+                print("Action '{}' failed to validate".format(action))
+                misfits_history += 1
+            for action_element in action.elements:
+                if not history.contains_element(action_element):
+                    novel_elements += 1
+            if i < len(actions) - 1 and isinstance(action.get_action_targets(), dict):
+                history.add_action(action, t)
+    finally:
+        history.rollback(snapshot)
     return misfits_history, novel_elements
 
 # this is the most important function for tobor - this tells him how good a sentence is
 # we want to strongly encourage sentences having actions (for obvious reasons)
 # we want to increase the penalty for adding novel elements as the story gets longer
 # we also want to discourage overly long or short sentences
-def score_sentence(sentence, history, reject_incomplete=True):
-    actions = grammar_parse.sentence_to_actions(' '.join([x for x in sentence if x is not None]))
+# if we've already got the actions for the sentence, we can pass them in and skip the parse
+def score_sentence(sentence, history, reject_incomplete=True, actions=None):
+    story_metrics.current.leaves_scored += 1
+    if actions is None:
+        actions = grammar_parse.get_extractor(reject_incomplete).sentence_to_actions(join_sentence(sentence))
     misfits_history, novel_elements = score_actions(actions, history, reject_incomplete)
     novel_penalty = float(len(history.unique_elements)) / 10
-    ideal_length = 18
+    ideal_length = IDEAL_SENTENCE_LENGTH
     distance = abs(len(sentence) - ideal_length) / ideal_length
     return (len(actions) / (misfits_history + (novel_penalty * novel_elements) + (distance * len(actions)) + 1))
 
-# this takes part of a sentence and figures out what word best comes next
+# the cheap first look at adding a word to a sentence - no parse needed, so we can afford it for every word that can follow
+# count / total is how often the word follows the sentence's key, and the word frequency is how common it is in everything tobor has been fed
+def quick_score(sentence, word, count, total, chain):
+    return (math.log(count / total) + FREQUENCY_SCORE_MOD * math.log(chain.word_frequency(word))
+            - DUPLICATE_SCORE_MOD * sentence.count(word))
+
+# returns the 'width' words (out of the words which can follow the key) with the best quick score, best first
+# only these go on to get a full score - the rest are never looked at again
+def prune_successors(sentence, chain, key, words, width):
+    if len(words) <= width:
+        return list(words)
+    # the search usually has the key's successors already
+    successors = words if isinstance(words, dict) else chain[key]
+    total = sum(successors.values())
+    ranked = sorted(words, key=lambda word: quick_score(sentence, word, successors[word], total, chain), reverse=True)
+    story_metrics.current.pruned(len(ranked) - width)
+    return ranked[:width]
+
+# a node in the lookahead tree - a (partial) sentence, the key at the end of it, and the sentences that can follow it
+# generate_sentence keeps the tree for the whole sentence: once a word is picked, its subtree becomes the new root
+# so everything we've already expanded (and every score we've already worked out) is kept for the next word
+class SearchNode:
+    def __init__(self, sentence, key, sample_count=None, prune_width=None):
+        self.sentence = sentence
+        self.key = key
+        # if this is set, we only look at this many weighted draws of the words which can follow the sentence rather than all of them
+        self.sample_count = sample_count
+        # if this is set, we only look at this many of the words which can follow the sentence - the ones with the best quick score
+        self.prune_width = prune_width
+        # maps each word which can follow this sentence to its node - None until we first look
+        self.children = None
+        # maps reject_incomplete to the score this sentence got - the history doesn't change within a sentence, so neither does the score
+        self.scores = {}
+
+    def expand(self, chain):
+        if self.children is None:
+            self.children = {}
+            if self.sample_count is None:
+                words = chain[self.key]
+            else:
+                words = chain.sample_successors(self.key, self.sample_count)
+            if self.prune_width is not None:
+                words = prune_successors(self.sentence, chain, self.key, words, self.prune_width)
+            for word in words:
+                self.children[word] = self.child(word)
+            story_metrics.current.expanded(len(self.children))
+        return self.children
+
+    def child(self, word):
+        return SearchNode(self.sentence + [word], self.key[1:] + (word,), self.sample_count, self.prune_width)
+
+    # returns the node for this sentence with the word added - if we've already built it, it comes with its whole subtree
+    def descend(self, word):
+        if self.children is not None and word in self.children:
+            return self.children[word]
+        return self.child(word)
+
+    def score(self, history, reject_incomplete):
+        if reject_incomplete not in self.scores:
+            self.scores[reject_incomplete] = score_sentence(self.sentence, history, reject_incomplete)
+        return self.scores[reject_incomplete]
+
+# this takes part of a sentence (the root node of the lookahead tree) and figures out what word best comes next
 # returns the word and score associated with the sentence having added that word
-def get_next_word(sentence, key, chain, depth, history, last_sentence):
+# if a deadline (from time.monotonic) is given and we're still searching when it passes, this raises OutOfTime
+def get_next_word(node, chain, depth, history, last_sentence, deadline=None):
+    if deadline is not None and time.monotonic() > deadline:
+        raise OutOfTime()
+    sentence = node.sentence
     if depth == 0:
         # yep, this is recursion
         # this means that we've looked a few words into the future, and we want to evaluate how good this future is
         # we don't care what words are here (we'll calculate those later), but we want to know how good the sentence is
         # in this case, we might not be done building the sentence, so we won't penalize an incomplete action (i.e. 'Jack gives...' would be penalized otherwise)
-        return None, score_sentence(sentence, history, reject_incomplete=False)
+        return None, node.score(history, reject_incomplete=False)
     if last_sentence:
         # save a little bit of time here - if it's the last sentence, and we've finished it, we don't need to look into the future of sentences we can't generate
-        if len(sentence) > 0 and util.is_terminal_word(sentence[-1]):
-            return None, score_sentence(sentence, history, reject_incomplete=True)
+        if len(sentence) > 0 and story_util.is_terminal_word(sentence[-1]):
+            return None, node.score(history, reject_incomplete=True)
     # if, for whatever reason, the sequence of words we have never shows up in the text tobor has been fed, then we just stop the generation
     # this should be a rare (maybe even impossible) case
-    if key not in chain:
-        return None, score_sentence(sentence, history, reject_incomplete=True)
+    if node.key not in chain:
+        return None, node.score(history, reject_incomplete=True)
     # we're now interested in figuring out which of the possible words fits best
     max_score = -float('inf')
     max_word = None
-    # print("Getting word from key: {} and bank: {}".format(key, chain[key]))
-    for word in chain[key]:
-        # for every possible word, we make a copy of the starting sentence and add the word to it
-        temp_sentence = list(sentence)
-        temp_sentence.append(word)
-        # we then recurse on this new sentence to get the best estimated score this word can lead us to
-        temp_key = key[1:] + (word,)
-        _, score = get_next_word(temp_sentence, temp_key, chain, depth - 1, history, last_sentence)
+    # every possible word gives us a new sentence (the child node) - if we looked at this sentence for the last word, these are already built
+    for word, child in node.expand(chain).items():
+        # we recurse on the new sentence to get the best estimated score this word can lead us to
+        _, word_score = get_next_word(child, chain, depth - 1, history, last_sentence, deadline)
         # if the best score from this word is better than our current best, we update our max score and remember this word
-        if score > max_score:
-            max_score = score
+        if word_score > max_score:
+            max_score = word_score
             max_word = word
-        elif score == max_score:
+        elif word_score == max_score:
             # we want to avoid getting stuck in loops if all words have equal scores
             roll = random.random()
             if roll > 0.5:
@@ -96,8 +264,167 @@ def get_next_word(sentence, key, chain, depth, history, last_sentence):
     # and now we return whichever word was best as well as the score it will give us
     return max_word, max_score
 
+# this walks the same tree as get_next_word, but instead of scoring the sentences at the bottom it just collects them
+# frontier is filled with (node, reject_incomplete) pairs - one for every score get_next_word would have to work out
+def get_frontier(node, chain, depth, last_sentence, frontier):
+    if depth == 0:
+        reject_incomplete = False
+    elif last_sentence and len(node.sentence) > 0 and story_util.is_terminal_word(node.sentence[-1]):
+        reject_incomplete = True
+    elif node.key not in chain:
+        reject_incomplete = True
+    else:
+        for child in node.expand(chain).values():
+            get_frontier(child, chain, depth - 1, last_sentence, frontier)
+        return
+    if reject_incomplete not in node.scores:
+        frontier.append((node, reject_incomplete))
+
+# this picks the same word as get_next_word, but parses all of the sentences at the bottom of the search in one batch
+# we first gather the whole frontier, hand it to spacy in one go, score everything, then run the normal search over those scores
+def get_next_word_batched(node, chain, depth, history, last_sentence):
+    frontier = []
+    get_frontier(node, chain, depth, last_sentence, frontier)
+    # finished and unfinished sentences can be parsed differently (see grammar_parse.get_extractor), so each gets its own batch
+    for reject_incomplete in (False, True):
+        leaves = [leaf for leaf, leaf_reject_incomplete in frontier if leaf_reject_incomplete == reject_incomplete]
+        structures = grammar_parse.get_extractor(reject_incomplete).parse_batch([join_sentence(leaf.sentence) for leaf in leaves])
+        for leaf in leaves:
+            actions = grammar_parse.structure_to_actions(structures[join_sentence(leaf.sentence)])
+            leaf.scores[reject_incomplete] = score_sentence(leaf.sentence, history, reject_incomplete, actions)
+    return get_next_word(node, chain, depth, history, last_sentence)
+
+# this is the same search as get_next_word, but each part of the sentence only looks at a few weighted draws of the words which can follow it
+# so the tree has at most LOOKAHEAD_SAMPLE_COUNT branches at each level, however many words tobor knows
+def get_next_word_sampled(node, chain, depth, history, last_sentence):
+    node.sample_count = LOOKAHEAD_SAMPLE_COUNT
+    return get_next_word(node, chain, depth, history, last_sentence)
+
+# this is the same search as get_next_word, but each part of the sentence only looks at the PRUNE_WIDTH words with the best quick score
+# so the tree has at most PRUNE_WIDTH ** depth sentences to parse at the bottom, however many words tobor knows
+def get_next_word_pruned(node, chain, depth, history, last_sentence):
+    node.prune_width = PRUNE_WIDTH
+    return get_next_word(node, chain, depth, history, last_sentence)
+
+# this picks the next word with a beam search - rather than following every possible future, we only keep the best few
+# at every step, each partial sentence in the beam is extended by each word that can follow it, and we keep the best 'width' results
+# returns the first word of the best sentence we found and that sentence's score
+def get_next_word_beam(node, chain, depth, history, last_sentence, width=BEAM_WIDTH):
+    if node.key not in chain:
+        return None, node.score(history, reject_incomplete=True)
+    # each entry in the beam is (sentence, key, first word, score, finished)
+    beam = [(node.sentence, node.key, None, 0, False)]
+    for _ in range(depth):
+        candidates = []
+        for entry in beam:
+            beam_sentence, beam_key, first_word, _, finished = entry
+            if finished:
+                # there's nothing left to add to this one, but it still competes with the others
+                candidates.append(entry)
+                continue
+            # only the best few words (by quick score) from each sentence get parsed
+            successors = prune_successors(beam_sentence, chain, beam_key, chain[beam_key], PRUNE_WIDTH)
+            story_metrics.current.expanded(len(successors))
+            for word in successors:
+                next_sentence = beam_sentence + [word]
+                next_key = beam_key[1:] + (word,)
+                # the same rules get_next_word uses to stop looking further ahead
+                done = (last_sentence and story_util.is_terminal_word(word)) or next_key not in chain
+                candidates.append((next_sentence, next_key, word if first_word is None else first_word, None, done))
+        if not any(entry[3] is None for entry in candidates):
+            # every sentence in the beam is finished
+            beam = candidates
+            break
+        # we parse everything new at this level in one go (one batch for finished sentences, one for the rest - see grammar_parse.get_extractor)
+        structures = {}
+        for finished in (False, True):
+            structures[finished] = grammar_parse.get_extractor(finished).parse_batch(
+                [join_sentence(entry[0]) for entry in candidates if entry[3] is None and entry[4] == finished])
+        scored = []
+        for beam_sentence, beam_key, first_word, score, finished in candidates:
+            if score is None:
+                actions = grammar_parse.structure_to_actions(structures[finished][join_sentence(beam_sentence)])
+                score = score_sentence(beam_sentence, history, reject_incomplete=finished, actions=actions)
+            scored.append((beam_sentence, beam_key, first_word, score, finished))
+        # shuffling first means that equally good sentences are kept in a random order, so we don't get stuck in loops
+        random.shuffle(scored)
+        scored.sort(key=lambda entry: entry[3], reverse=True)
+        beam = scored[:width]
+    best = max(beam, key=lambda entry: entry[3])
+    return best[2], best[3]
+
+class OutOfTime(Exception):
+    pass
+
+# keeps track of how much time the story being told has left - see get_next_word_anytime
+class SearchClock:
+    def __init__(self, story_budget=STORY_TIME_BUDGET, sentence_budget=SENTENCE_TIME_BUDGET):
+        self.story_deadline = time.monotonic() + story_budget
+        self.sentence_budget = sentence_budget
+        self.sentence_deadline = self.story_deadline
+
+    # each sentence gets an even share of the time the story has left, but never more than the sentence budget
+    def start_sentence(self, sentences_left):
+        now = time.monotonic()
+        share = max(self.story_deadline - now, 0) / max(sentences_left, 1)
+        self.sentence_deadline = now + min(share, self.sentence_budget)
+
+    # we don't know how long the sentence will end up, so each word gets a share of what's left as if it will be IDEAL_SENTENCE_LENGTH
+    # once it's longer than that, each word gets half of what's left
+    def word_deadline(self, sentence_length):
+        now = time.monotonic()
+        words_left = max(IDEAL_SENTENCE_LENGTH - sentence_length, 2)
+        return now + max(self.sentence_deadline - now, 0) / words_left
+
+# the clock for the story being told right now - generate_sentences starts a new one for every story
+search_clock = SearchClock()
+
+# this is the same search as get_next_word, but it looks one word ahead, then two, and so on until it runs out of time (or gets to depth)
+# the tree (and every score in it) is kept between rounds, so each round only pays for its new bottom level
+# if the time runs out partway through a round, we go with the word the last finished round picked
+# if not even the first round finished, we just take a weighted draw of the words that can come next
+# each part of the sentence is pruned down to its PRUNE_WIDTH best words first, so each round can go deeper in the same time
+def get_next_word_anytime(node, chain, depth, history, last_sentence):
+    node.prune_width = PRUNE_WIDTH
+    deadline = search_clock.word_deadline(len(node.sentence))
+    best_word, best_score = None, -float('inf')
+    reached = 0
+    out_of_time = False
+    for round_depth in range(1, depth + 1):
+        try:
+            best_word, best_score = get_next_word(node, chain, round_depth, history, last_sentence, deadline)
+        except OutOfTime:
+            out_of_time = True
+            break
+        reached = round_depth
+        if node.children is None:
+            # the search stopped before it needed any successors (e.g. the sentence is over) - looking further won't change that
+            break
+    story_metrics.current.searched(reached, out_of_time)
+    if reached == 0:
+        words = chain.sample_successors(node.key, 1)
+        if len(words) == 0:
+            return None, node.score(history, reject_incomplete=True)
+        return words[0], -float('inf')
+    return best_word, best_score
+
+# the different ways tobor can look ahead when picking words
+# each maps to a search function (these all take the same arguments and return (word, score)) and how far that search looks ahead
+search_mode_map = {
+    'exhaustive': (get_next_word, SEARCH_DEPTH),
+    'batched': (get_next_word_batched, SEARCH_DEPTH),
+    'sampled': (get_next_word_sampled, SEARCH_DEPTH),
+    'pruned': (get_next_word_pruned, SEARCH_DEPTH),
+    'beam': (get_next_word_beam, BEAM_SEARCH_DEPTH),
+    'anytime': (get_next_word_anytime, ANYTIME_MAX_DEPTH)
+}
+
 # this generates a new sentence based on the words before it
-def generate_sentence(chain, key, history, is_first_sentence, is_last_sentence):
+# depth is how far to look ahead - by default, whatever the search mode is set up for
+def generate_sentence(chain, key, history, is_first_sentence, is_last_sentence, mode=DEFAULT_SEARCH_MODE, depth=None):
+    search, mode_depth = search_mode_map[mode]
+    if depth is None:
+        depth = mode_depth
     if is_first_sentence:
         # our key is actually part of the first sentence.
         sentence = list(key)
@@ -105,35 +432,62 @@ def generate_sentence(chain, key, history, is_first_sentence, is_last_sentence):
         sentence = []
     score = -1
 
+    # the root of the lookahead tree - we keep walking down it as we pick words
+    node = SearchNode(sentence, key)
     while len(sentence) == 0 or not story_util.is_terminal_word(sentence[-1]) and len(sentence) < MAX_SENTENCE_LENGTH:
         # while our sentence isn't finished (note the syntax sentence[-1] is the same as saying the last word of the sentence)
         # we get the next word in the sentence (using the above function) and add it to the sentence
-        next_word, score = get_next_word(sentence, key, chain, SEARCH_DEPTH, history, is_last_sentence)
-        sentence.append(next_word)
-        # we update the key to be the last 'n' words of the sentence again
-        # we get the last n-1 elements of the key, then add the last word onto it
-        key = key[1:] + (next_word,)
-    actions = grammar_parse.sentence_to_actions(' '.join([s for s in sentence if s is not None]))
+        next_word, score = search(node, chain, depth, history, is_last_sentence)
+        # the node for the new sentence also knows the new key (the last n-1 elements of the key, then the new word)
+        node = node.descend(next_word)
+        sentence = node.sentence
+        key = node.key
+    story_metrics.current.sentences += 1
+    if not story_util.is_terminal_word(sentence[-1]):
+        # we gave up on this one at MAX_SENTENCE_LENGTH
+        story_metrics.current.sentences_truncated += 1
+    actions = grammar_parse.sentence_to_actions(join_sentence(sentence))
     score = score_sentence(sentence, history, reject_incomplete=True)
     print("Sentence: {} - Score: {}".format(sentence, score))
     return sentence, actions, score
 
-def generate_story_of_length(length):
-    if len(word_bank.keys()) == 0:
+def generate_story_of_length(length, mode=DEFAULT_SEARCH_MODE, chain=None):
+    history = History()
+    sentences = []
+    total_score = 0
+    for sentence, score in generate_sentences(length, mode, chain, history):
+        sentences.append(sentence)
+        total_score += score
+    if len(sentences) == 0:
         # this is what happens if tobor doesn't have any info
-        return "No data", 0, None
-    # we start our story with a random batch of words from the lookup table
-    first_phrase = random.choice(list(word_bank.keys()))
-    while first_phrase[0].islower() or not first_phrase[0].isalpha():
-        # we have enough data that we can look for chunks where the first word is uppercase
-        first_phrase = random.choice(list(word_bank.keys()))
+        return NO_DATA, 0, None
+    # this uses python features to join every word in every sentence with a space, then joins the sentences with a space as well
+    sentences = " ".join([join_sentence(x) for x in sentences])
+    return sentences, total_score, history
+
+# tells the story one sentence at a time - yields each sentence (a list of words) and its score as soon as it's finished
+# the history is filled in as we go, so whoever is reading can see what happened so far
+# yields nothing at all if tobor doesn't know anything that could start a story
+def generate_sentences(length, mode=DEFAULT_SEARCH_MODE, chain=None, history=None, depth=None):
+    global search_clock
+    if chain is None:
+        chain = word_bank
+    if history is None:
+        history = History()
+    if len(chain) == 0:
+        return
+    # we start our story with a random batch of words from the lookup table, where the first word is uppercase
+    first_phrase = chain.random_start_key(WEIGHTED_STORY_START)
+    if first_phrase is None:
+        # nothing tobor has been fed could start a story
+        return
     key = first_phrase
     sentences = []
-    history = History()
-    total_score = 0
+    search_clock = SearchClock()
     for i in range(length + 1):
+        search_clock.start_sentence(length + 1 - i)
         # get a sentence
-        next_sentence, actions, score = generate_sentence(word_bank, key, history, i == 0,  i == length - 1)
+        next_sentence, actions, score = generate_sentence(chain, key, history, i == 0,  i == length - 1, mode, depth)
         # if i > 0:
         #     test_set = set(next_sentence + sentences[-1])
         #     if len(test_set) < len(next_sentence) / 2:
@@ -144,8 +498,8 @@ def generate_story_of_length(length):
         for action in actions:
             history.add_action(action, i)
         sentences.append(next_sentence)
-        total_score += score
-        n = MARKOV_LENGTH
+        yield next_sentence, score
+        n = chain.n
         # now we need to figure out what the key is for the next sentence
         if len(next_sentence) >= n:
             # if the new sentence we have has at least n words in it, we can just use the last n words of the sentence as the key
@@ -170,48 +524,150 @@ def generate_story_of_length(length):
             assert len(key) == n
             # we convert the key to a tuple from a list
             key = tuple(key)
-    # this uses python features to join every word in every sentence with a space, then joins the sentences with a space as well
-    sentences = " ".join([" ".join([s for s in x if s is not None]) for x in sentences])
-    return sentences, total_score, history
 
 def chunk_story(story, chunk_size):
-    # discord tts can only speak up to 200 characters at once (but 200 doesn't seem to be accurate)
-    story_fragments = [""]
-    char_count = 0
-    frag_count = 0
-    for word in story:
-        if char_count + len(word) + 1 < chunk_size:
-            # if the word is short enough to fit within the limit, we just add it
-            char_count += len(word) + 1
-            story_fragments[frag_count] += word + ' '
-        else:
-            # otherwise we have to put the word into a new block of its own
-            frag_count += 1
-            char_count = len(word) + 1
-            story_fragments.append("")
-            story_fragments[frag_count] += word + ' '
-    # we clear out any extra white space from the fragments and return them
-    story_fragments = [x.strip() for x in story_fragments]
-    return story_fragments
+    packer = ChunkPacker(chunk_size)
+    return packer.add(story) + packer.finish()
 
-def feed_generator(input):
-    # we write the text we were given out to the text file for my records
-    with open(babel_library, 'a', encoding='utf-8') as datafile:
-        datafile.write(f'\n{input}')
-    # we now split up the input text into words by whitespace
-    cleaned = input.split()
-    # we get all of the word chunks
-    for words, tail in story_util.get_word_combos(cleaned, n=MARKOV_LENGTH):
-        if words in word_bank:
-            # if the word chunk is already in the database:
-            if tail in word_bank[words]:
-                # and the tail is already an option which can follow the chunk, we just increment the count of that tail (used to prevent super long lists)
-                word_bank[words][tail] += 1
+# splits a story into messages that are no longer than chunk_size as the words come in, rather than all at once at the end
+# add returns every chunk which has been filled up, and finish returns whatever is left
+class ChunkPacker:
+    def __init__(self, chunk_size):
+        # discord tts can only speak up to 200 characters at once (but 200 doesn't seem to be accurate)
+        self.chunk_size = chunk_size
+        self.fragment = ""
+        self.char_count = 0
+
+    def add(self, words):
+        full_fragments = []
+        for word in words:
+            if self.char_count + len(word) + 1 < self.chunk_size:
+                # if the word is short enough to fit within the limit, we just add it
+                self.char_count += len(word) + 1
+                self.fragment += word + ' '
             else:
-                # otherwise, we just add the tail word as another option which can follow the chunk
-                word_bank[words][tail] = 1
+                # otherwise we have to put the word into a new block of its own
+                full_fragments.append(self.fragment.strip())
+                self.char_count = len(word) + 1
+                self.fragment = word + ' '
+        return full_fragments
+
+    # the chunk that's still being filled up
+    def current(self):
+        return self.fragment.strip()
+
+    def finish(self):
+        # we clear out any extra white space from the fragment
+        fragment = self.fragment.strip()
+        self.fragment = ""
+        self.char_count = 0
+        return [fragment]
+
+# returns how many words tobor was fed
+def feed_generator(input):
+    # this is just a stream with one chunk in it
+    stream = FeedStream()
+    stream.feed_text(input)
+    stream.finish()
+    return stream.word_count
+
+# this makes sure two feeds don't write to the journal or the bank at the same time
+feed_lock = threading.Lock()
+
+# feeds tobor a text a piece at a time, so we never need the whole thing in memory at once
+# give it chunks of bytes (feed_bytes) or text (feed_text) in order, then call finish
+# the counts end up exactly as if feed_generator had been given the whole text
+# the words are kept in a temporary file until finish, then added to the library in one go - so two feeds at once don't get mixed up in it
+class FeedStream:
+    def __init__(self, batch_size=FEED_BATCH_WORDS):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        # the end of the last chunk, if it stopped in the middle of a word
+        self.partial_word = ''
+        # the last few words we've seen - the chunks which start the next chunk's first few word combos
+        self.carry = []
+        self.deltas = {}
+        self.batch_size = batch_size
+        self.pending_words = 0
+        self.word_count = 0
+        # the words for the library - None until there are some
+        self.staged = None
+
+    # if the bytes stop being utf-8 partway through, the text before that is still fed before the error is raised
+    # (so finish(complete=False) can end the feed with everything up to the bad byte)
+    def feed_bytes(self, data):
+        try:
+            text = self.decoder.decode(data)
+        except UnicodeDecodeError as e:
+            # the error's object has any bytes left over from the last chunk on the front, so the start lines up with it
+            self.feed_text(e.object[:e.start].decode('utf-8'))
+            raise
+        self.feed_text(text)
+
+    def feed_text(self, text):
+        text = self.partial_word + text
+        words = text.split()
+        if len(words) > 0 and not text[-1].isspace():
+            # the last word might carry on in the next chunk
+            self.partial_word = words.pop()
         else:
-            # otherwise, we add the chunk to the database
-            word_bank[words] = { tail: 1 }
-    # we figure out where we're saving the data to and save it out to disk
-    util.save_data(babel_store, word_bank)
\ No newline at end of file
+            self.partial_word = ''
+        self.add_words(words)
+
+    def add_words(self, words):
+        # we write the words out to the text file for my records - as words rather than the text we were given, so the whole feed
+        # stays on one line however many lines it had (rebuild_bank.py and the n-gram index count every line as its own feed)
+        if len(words) > 0:
+            if self.staged is None:
+                self.staged = tempfile.TemporaryFile('w+', encoding='utf-8')
+                self.staged.write('\n')
+            else:
+                self.staged.write(' ')
+            self.staged.write(' '.join(words))
+        n = MARKOV_LENGTH
+        self.word_count += len(words)
+        self.pending_words += len(words)
+        words = self.carry + words
+        # these are all of the word combos that can't be changed by anything that comes later
+        for i in range(len(words) - n):
+            key = tuple(words[i:i+n])
+            self.deltas[(key, words[i+n])] = self.deltas.get((key, words[i+n]), 0) + 1
+        self.carry = words[-n:]
+        if self.pending_words >= self.batch_size:
+            self.flush()
+
+    # writes the counts we have so far to the journal, then adds them to the bank
+    def flush(self):
+        if not any(self.deltas):
+            return
+        with feed_lock:
+            # the counts go on the end of the journal first, so that they're safe on disk before we use them
+            journal.append([(words, tail, count) for (words, tail), count in self.deltas.items()])
+            for (words, tail), count in self.deltas.items():
+                word_bank.increment(words, tail, count)
+        self.deltas = {}
+        self.pending_words = 0
+
+    # complete is False if we couldn't get (or decode) the whole text - the feed ends with whatever we've got so far, since some of it
+    # may already be in the bank, and any bytes that were waiting on the rest of a character are dropped
+    def finish(self, complete=True):
+        text = (self.decoder.decode(b'', final=True) if complete else '') + self.partial_word
+        self.partial_word = ''
+        self.add_words(text.split())
+        # the end of the text gets its own special word combos (see get_word_combos)
+        for words, tail in story_util.get_word_combos(self.carry, n=MARKOV_LENGTH):
+            self.deltas[(words, tail)] = self.deltas.get((words, tail), 0) + 1
+        self.carry = []
+        self.flush()
+        if self.staged is not None:
+            self.staged.seek(0)
+            with feed_lock, open(babel_library, 'a', encoding='utf-8') as datafile:
+                shutil.copyfileobj(self.staged, datafile)
+            self.staged.close()
+            self.staged = None
+        # the n-gram index doesn't know about this text, so it gets rebuilt the next time it's needed
+        global ngram_index
+        ngram_index = None
+        # every so often we fold the journal into the bank file, so it doesn't take forever to replay
+        with feed_lock:
+            if journal.size() > JOURNAL_COMPACT_SIZE:
+                compact_bank()
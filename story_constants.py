@@ -22,6 +22,89 @@ FREQUENCY_SCORE_MOD = 0.25
 DUPLICATE_SCORE_MOD = 0.5
 MAX_SENTENCE_LENGTH = 100
 
+# feeding tobor appends to a journal instead of rewriting the whole word bank
+# once the journal gets bigger than this many bytes, it's folded into the bank (this also happens when tobor shuts down)
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+
+# big texts are fed to tobor a chunk at a time - this is how many bytes we read at once
+# and how many words we collect before adding their counts to the bank
+FEED_CHUNK_SIZE = 64 * 1024
+FEED_BATCH_WORDS = 50000
+# how often (in seconds) tobor reports how far through a file he is
+FEED_PROGRESS_INTERVAL = 5
+
+# the spacy model tobor parses with, and the parts of its pipeline we don't load at all
+# we only read part of speech tags, the dependency parse and lemmas (tok2vec, tagger, attribute_ruler, parser and lemmatizer)
+# so e.g. the named entity recognizer would just be slowing every parse down
+SPACY_MODEL = "en_core_web_sm"
+SPACY_EXCLUDED_PIPES = ["ner"]
+
+# how many parsed sentences tobor remembers - lookahead parses the same sentence fragments many times over
+PARSE_CACHE_SIZE = 20000
+# parses are also kept in this file, so they don't have to be done again after tobor restarts (None turns this off)
+# it holds at most PARSE_STORE_SIZE parses - the ones used least recently are deleted first
+PARSE_STORE_PATH = "tobor-parses.sqlite3"
+PARSE_STORE_SIZE = 500000
+
+# what the search scores the sentences it's only looking ahead at with - 'spacy', or 'nltk' (a part of speech tagger and a chunker)
+# nltk is many times faster but only roughly agrees with spacy (see benchmarks/action_extractors.py), and needs its tagger downloaded:
+# nltk.download('averaged_perceptron_tagger_eng') - finished sentences and the story history always use spacy
+LEAF_EXTRACTOR = 'spacy'
+
+# the 'batched' search parses every sentence at the bottom of the lookahead in one nlp.pipe call
+# batch size is how many sentences spacy works on at once, and process count is how many processes it spreads them over
+PARSE_BATCH_SIZE = 256
+PARSE_PROCESS_COUNT = 1
+
+# the 'beam' search only keeps the best few partial sentences at each step instead of looking at every possible future
+# its cost grows linearly with depth (depth * width * successors), so it can afford to look much further ahead
+BEAM_WIDTH = 8
+BEAM_SEARCH_DEPTH = 6
+
+# the 'anytime' search keeps looking one word further ahead (up to ANYTIME_MAX_DEPTH) until it runs out of time
+# each story gets STORY_TIME_BUDGET seconds, shared out between its sentences (no more than SENTENCE_TIME_BUDGET for any one)
+# and each word gets a share of its sentence's time - when that runs out, we go with the best word from the deepest search we finished
+ANYTIME_MAX_DEPTH = 5
+STORY_TIME_BUDGET = 240
+SENTENCE_TIME_BUDGET = 30
+
+# how many words a sentence should have - scoring penalizes sentences the further they are from this
+IDEAL_SENTENCE_LENGTH = 18
+
+# when true, stories are more likely to start with phrases which show up more often in what tobor has been fed
+WEIGHTED_STORY_START = False
+
+# the 'sampled' search only looks at a few of the words which can follow each part of a sentence
+# it makes this many draws (weighted by how often each word follows), so common words are almost always looked at
+LOOKAHEAD_SAMPLE_COUNT = 4
+# how many keys' alias tables (used for those weighted draws) we keep around at once
+ALIAS_TABLE_CACHE_SIZE = 100000
+
+# before anything gets parsed, the words which can follow each part of a sentence are ranked by a cheap score:
+# how often the word follows those words, how common it is overall (times FREQUENCY_SCORE_MOD), and how many times
+# the sentence already has it (times DUPLICATE_SCORE_MOD) - the 'pruned', 'anytime' and 'beam' searches only look
+# further at the best PRUNE_WIDTH of them, so the number of sentences they parse doesn't grow with the vocabulary
+PRUNE_WIDTH = 6
+
+# which lookahead tobor uses when nobody asks for a particular one - see search_mode_map in story.py
+DEFAULT_SEARCH_MODE = 'anytime'
+
+# stories are generated in a pool of worker processes so the bot keeps responding in the meantime
+# a story taking longer than STORY_TIMEOUT seconds is abandoned (and the workers restarted)
+STORY_WORKER_COUNT = 2
+STORY_TIMEOUT = 300
+# how often (in seconds) we check that the worker telling a story hasn't died while we wait for its next sentence
+STORY_QUEUE_POLL_INTERVAL = 1
+# tobor keeps STORY_POOL_SIZE stories of each length told in advance, so most story requests can be answered straight away
+# a pooled story is thrown out once it's STORY_POOL_MAX_AGE seconds old, or once tobor has been fed STORY_POOL_FEED_WORDS words since it was told
+# the pool is checked for old stories every STORY_POOL_CHECK_INTERVAL seconds even if nothing else happens
+STORY_POOL_SIZE = 2
+STORY_POOL_MAX_AGE = 6 * 60 * 60
+STORY_POOL_FEED_WORDS = 1000
+STORY_POOL_CHECK_INTERVAL = 10 * 60
+# how many stories we keep search statistics for (see 'metrics story')
+STORY_METRICS_HISTORY = 20
+
 # a mapping between verbs and their root meaning - e.g. 'stagger' gets mapped to 'move'
 # only contains verbs which should significantly change the state of the story
 VERB_ROOT_MAP = {
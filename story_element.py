@@ -1,6 +1,17 @@
-import uuid
+import types
+import itertools
+
+# every element and action gets its own number - these only need to be unique within one process
+# (they used to be uuids, but reading os.urandom for every element of every sentence we score adds up)
+element_ids = itertools.count()
+
+# what the state history of an element looks like before anything has happened to it
+# every such element shares this, so it can't be changed - see StoryElement.add_state
+empty_state_history = types.MappingProxyType({"location": (), "parent": (), "extant": ()})
 
 class State:
+    __slots__ = ('name', 'value', 't')
+
     def __init__(self, name, value, timestep):
         self.name = name
         self.value = value
@@ -13,22 +24,68 @@ class History:
     def __init__(self):
         self.actions = []
         self.unique_elements = set()
+        # every element in the history by its id, and every element with a given name - so we never have to scan for one
+        self.elements_by_id = {}
+        self.elements_by_name = {}
         self.last_added_element = -1
+        # while a snapshot is taken, everything add_action changes is written down here so that rollback can undo it
+        # this means lookahead can try out an action without copying the history (or the elements in it)
+        self.undo_log = None
 
     def add_action(self, action, t):
         self.actions.append(action)
+        last_added_element = self.last_added_element
+        new_elements = []
         for el in action.elements:
-            if el.uuid not in self.unique_elements:
-                self.unique_elements.add(el)
+            if el.id not in self.elements_by_id:
+                self.add_element(el)
+                new_elements.append(el)
                 self.last_added_element = action.t
+        if self.undo_log is not None:
+            # actions only ever append to the histories of their own elements, so remembering how long those were is enough to undo them
+            lengths = [(el, el.history_lengths()) for el in action.elements]
+            self.undo_log.append((action, action.t, last_added_element, new_elements, lengths))
         action.apply(t)
 
+    def add_element(self, element):
+        self.unique_elements.add(element)
+        self.elements_by_id[element.id] = element
+        self.elements_by_name.setdefault(element.name, []).append(element)
+
+    def remove_element(self, element):
+        self.unique_elements.discard(element)
+        del self.elements_by_id[element.id]
+        named = self.elements_by_name[element.name]
+        named.remove(element)
+        if len(named) == 0:
+            del self.elements_by_name[element.name]
+
     def contains_element(self, element):
-        query_id = element.uuid
-        for e in self.unique_elements:
-            if query_id == e.uuid:
-                return True
-        return False
+        return element.id in self.elements_by_id
+
+    # starts (or nests) a snapshot - returns a marker to hand to rollback or release later
+    def snapshot(self):
+        if self.undo_log is None:
+            self.undo_log = []
+        return len(self.undo_log)
+
+    # undoes every action added since the snapshot was taken
+    def rollback(self, snapshot):
+        while len(self.undo_log) > snapshot:
+            action, t, last_added_element, new_elements, lengths = self.undo_log.pop()
+            for el, el_lengths in lengths:
+                el.truncate_history(el_lengths)
+            for el in new_elements:
+                self.remove_element(el)
+            self.actions.pop()
+            action.t = t
+            self.last_added_element = last_added_element
+        self.release(snapshot)
+
+    # keeps every action added since the snapshot was taken - they can no longer be rolled back (unless an earlier snapshot is)
+    def release(self, snapshot):
+        if snapshot == 0:
+            self.undo_log = None
 
     # takes a tentative action and sees if we can map the elements within to existing elements
     # returns a new action with aligned elements
@@ -36,57 +93,97 @@ class History:
         # takes an element and compares against elements within history
         # returns given element or a new element it can be mapped into
         def map_element(element):
-            for e0 in self.unique_elements:
-                if element.uuid == e0.uuid:
-                    # we already have this element in our history, no need to map
-                    return element
-                if element.name != e0.name:
-                    # there are interesting cases here where the same object could have different names
-                    # for simplicity, we'll ignore those
-                    return element
-                if element.state_history["location"] != e0.state_history["location"]:
+            if element.id in self.elements_by_id:
+                # we already have this element in our history, no need to map
+                return element
+            # there are interesting cases here where the same object could have different names
+            # for simplicity, we'll ignore those
+            for e0 in self.elements_by_name.get(element.name, []):
+                if list(element.state_history["location"]) != list(e0.state_history["location"]):
                     # these elements are in different locations, so can't be the same
-                    return element
-                element_parent = element.state_history["parent"][-1]
-                if element_parent is not None and e0.state_history["parent"][-1] != element_parent:
-                    # our element has a known parent and it is different from the other's
-                    return element
-
+                    continue
+                if any(element.state_history["parent"]):
+                    element_parent = element.state_history["parent"][-1]
+                    if not any(e0.state_history["parent"]) or e0.state_history["parent"][-1] != element_parent:
+                        # our element has a known parent and it is different from the other's
+                        continue
                 # our two elements match in all significant fields, so element can be mapped to e0
                 return e0
+            return element
 
-        init = map_element(action.initiator)
-        receivers = [map_element(e) for e in action.receivers]
-        return Action(action.name, init, receivers)
+        initiators = [map_element(e) for e in action.initiators]
+        receivers = {obj_type: [map_element(e) for e in action.receivers[obj_type]] for obj_type in action.receivers}
+        return type(action)(action.name, initiators, receivers)
 
+# lookahead makes (and throws away) a lot of these, so they're kept as small as we can make them
+# most elements are only made to score a sentence and never have anything happen to them, so their histories are only made when something does
 class StoryElement:
-    def __init__(self, token, init_state=None, descriptors=None):
-        self.token = token
-        self.name = self.token.lower_
-        self.state_history = {
-            "location": [],
-            "parent": [],
-            "extant": []
-        }
+    __slots__ = ('name', 'descriptors', 'id', '_state_history', '_action_history')
+
+    def __init__(self, name, init_state=None, descriptors=None):
+        self.name = name
+        self._state_history = None
+        self._action_history = None
         if init_state is not None:
             for key in init_state:
-                if key in self.state_history:
-                    self.state_history[key].append(init_state[key])
-                else:
-                    self.state_history[key] = [init_state[key]]
+                self.add_state(key, init_state[key])
         self.descriptors = descriptors
-        self.action_history = []
-        self.uuid = uuid.uuid4()
+        self.id = next(element_ids)
+
+    # maps each kind of state ("location", "parent", "extant") to the list of states the element has had - use add_state to change it
+    @property
+    def state_history(self):
+        if self._state_history is None:
+            return empty_state_history
+        return self._state_history
+
+    # the (action, timestep) pairs of everything the element has been part of - use add_action to change it
+    @property
+    def action_history(self):
+        if self._action_history is None:
+            return ()
+        return self._action_history
+
+    def add_state(self, key, state):
+        if self._state_history is None:
+            self._state_history = {"location": [], "parent": [], "extant": []}
+        self._state_history.setdefault(key, []).append(state)
+
+    def add_action(self, action, t):
+        if self._action_history is None:
+            self._action_history = []
+        self._action_history.append((action, t))
+
+    # how long each of the element's histories is - truncate_history puts them back to these lengths
+    def history_lengths(self):
+        if self._state_history is None:
+            return len(self.action_history), None
+        return len(self.action_history), {key: len(states) for key, states in self._state_history.items()}
+
+    def truncate_history(self, lengths):
+        action_count, state_counts = lengths
+        if self._action_history is not None:
+            del self._action_history[action_count:]
+        if state_counts is None:
+            self._state_history = None
+        elif self._state_history is not None:
+            for key in list(self._state_history):
+                if key in state_counts:
+                    del self._state_history[key][state_counts[key]:]
+                else:
+                    del self._state_history[key]
 
     def __str__(self):
         if not any(self.descriptors):
             return self.name
-        return '{} {}'.format(' '.join([x.lower_ for x in self.descriptors]), self.name)
+        return '{} {}'.format(' '.join(self.descriptors), self.name)
 
     def __repr__(self):
         return str(self)
 
 class Action:
+    __slots__ = ('name', 'initiators', 'receivers', 'elements', 't', 'id')
+
     def __init__(self, name, e0, e1):
         self.name = name
         self.initiators = e0
@@ -95,7 +192,7 @@ class Action:
         for obj_type in self.receivers:
             self.elements += self.receivers[obj_type]
         self.t = -1
-        self.uuid = uuid.uuid4()
+        self.id = next(element_ids)
 
     # validates this action against a history
     # returns false if the action would break common rules (i.e. can't kill dead person)
@@ -112,7 +209,7 @@ class Action:
     def apply(self, t):
         self.t = t
         for e in self.elements:
-            e.action_history.append((self, self.t))
+            e.add_action(self, self.t)
 
     def __str__(self):
         obj_str = ', '.join([str(obj) + ' {}'.format(x) for x in self.receivers for obj in self.receivers[x]])
@@ -132,6 +229,8 @@ class Action:
 
 
 class MoveAction(Action):
+    __slots__ = ()
+
     def __init__(self, name, e0, e1):
         super().__init__(name, e0, e1)
 
@@ -155,6 +254,8 @@ class MoveAction(Action):
         super().apply(t)
 
 class GiveAction(Action):
+    __slots__ = ()
+
     def __init__(self, name, e0, e1):
         super().__init__(name, e0, e1)
 
@@ -193,9 +294,11 @@ class GiveAction(Action):
         # for now just assume everyone else gets a copy
         new_state = State("parent", recipients, t)
         for give_obj in give_objs:
-            give_obj.state_history["parent"].append(new_state)
+            give_obj.add_state("parent", new_state)
 
 class EmplaceAction(Action):
+    __slots__ = ()
+
     def __init__(self, name, e0, e1):
         super().__init__(name, e0, e1)
 
@@ -223,9 +326,11 @@ class EmplaceAction(Action):
         # we can share the state between all receivers - it's functionally immutable
         new_state = State("emplace", True, t)
         for target in receivers:
-            target.state_history["location"].append(new_state)
+            target.add_state("location", new_state)
 
 class TakeAction(Action):
+    __slots__ = ()
+
     def __init__(self, name, e0, e1):
         super().__init__(name, e0, e1)
 
@@ -265,9 +370,11 @@ class TakeAction(Action):
             return
         new_state = State("parent", self.initiators, t)
         for take_obj in take_objs:
-            take_obj.state_history["parent"].append(new_state)
+            take_obj.add_state("parent", new_state)
 
 class DestroyAction(Action):
+    __slots__ = ()
+
     def __init__(self, name, e0, e1):
         super().__init__(name, e0, e1)
 
@@ -284,9 +391,11 @@ class DestroyAction(Action):
 
         new_state = State('extant', False, t)
         for e in destroy_objs:
-            e.state_history['extant'].append(new_state)
+            e.add_state('extant', new_state)
 
 class FreeAction(Action):
+    __slots__ = ()
+
     def __init__(self, name, e0, e1):
         super().__init__(name, e0, e1)
 
@@ -313,4 +422,4 @@ class FreeAction(Action):
 
         new_state = State("emplace", False, t)
         for target in receivers:
-            target.state_history["location"].append(new_state)
\ No newline at end of file
+            target.add_state("location", new_state)
\ No newline at end of file
@@ -0,0 +1,128 @@
+import os
+import time
+from collections import deque
+from story_constants import *
+
+# counts what the search did while telling a story, so that when a story takes forever we can see why
+# e.g. a huge branching factor (lots of nodes), slow parses (parse time), or sentences that never end (truncated)
+class SearchStats:
+    def __init__(self, length=None, mode=None):
+        self.length = length
+        self.mode = mode
+        self.started = time.time()
+        self.wall_time = 0.0
+        self.sentences = 0
+        # sentences which hit MAX_SENTENCE_LENGTH before they hit an ending
+        self.sentences_truncated = 0
+        # nodes of the lookahead tree we found the following words for, and the most words any of them had
+        self.nodes_expanded = 0
+        self.max_branching = 0
+        # sentences we worked out a score for (these may or may not need a parse)
+        self.leaves_scored = 0
+        # words the searches which prune (see story.prune_successors) dropped on their quick score, without ever parsing them
+        self.candidates_pruned = 0
+        # sentences spacy actually parsed, and how long it took
+        self.parses = 0
+        self.parse_time = 0.0
+        # sentences the quicker nltk tagger looked at instead (see LEAF_EXTRACTOR), and how long it took
+        self.tags = 0
+        self.tag_time = 0.0
+        # for searches with a time limit ('anytime') - how many words were picked, how deep we got for them in total,
+        # the shallowest we got for any word, and how many words ran out of time before reaching the full depth
+        self.timed_words = 0
+        self.total_depth = 0
+        self.min_depth = None
+        self.deadline_hits = 0
+
+    def expanded(self, branching):
+        self.nodes_expanded += 1
+        if branching > self.max_branching:
+            self.max_branching = branching
+
+    def pruned(self, count):
+        self.candidates_pruned += count
+
+    def parsed(self, count, seconds):
+        self.parses += count
+        self.parse_time += seconds
+
+    def tagged(self, count, seconds):
+        self.tags += count
+        self.tag_time += seconds
+
+    def searched(self, depth, out_of_time):
+        self.timed_words += 1
+        self.total_depth += depth
+        if self.min_depth is None or depth < self.min_depth:
+            self.min_depth = depth
+        if out_of_time:
+            self.deadline_hits += 1
+
+    def average_depth(self):
+        return self.total_depth / self.timed_words if self.timed_words > 0 else 0.0
+
+    def finish(self):
+        self.wall_time = time.time() - self.started
+
+    def __str__(self):
+        summary = "{} {} story: {:.1f} s, {} sentences ({} truncated), {} nodes expanded (max branching {}), {} leaves scored, {} parses ({:.1f} s)".format(
+            self.length, self.mode, self.wall_time, self.sentences, self.sentences_truncated, self.nodes_expanded,
+            self.max_branching, self.leaves_scored, self.parses, self.parse_time)
+        if self.tags > 0:
+            summary += ", {} tagged ({:.1f} s)".format(self.tags, self.tag_time)
+        if self.candidates_pruned > 0:
+            summary += ", {} words pruned".format(self.candidates_pruned)
+        if self.timed_words > 0:
+            summary += ", depth {:.1f} on average (at least {}), {} of {} words ran out of time".format(
+                self.average_depth(), self.min_depth, self.deadline_hits, self.timed_words)
+        return summary
+
+# the statistics for the story being told right now
+current = SearchStats()
+# the statistics for the last few stories, oldest first
+recent = deque(maxlen=STORY_METRICS_HISTORY)
+
+def start_story(length, mode):
+    global current
+    current = SearchStats(length, mode)
+    return current
+
+def finish_story():
+    current.finish()
+    record(current)
+    return current
+
+# stories are told in worker processes (see story_workers), which send their statistics back for us to keep
+def record(stats):
+    if stats not in recent:
+        recent.append(stats)
+
+# for the 'metrics story' command - writes a summary of the last few stories to a file
+# returns the file name and a function which deletes it, or False if the arguments don't make sense
+def get_story_metrics_report(arguments):
+    output_filename = "story-metrics.txt"
+    def cleanup():
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+    if len(arguments) == 0:
+        count = len(recent)
+    else:
+        try:
+            count = int(arguments[0])
+        except ValueError:
+            return False
+    stories = list(recent)[-count:] if count > 0 else []
+    lines = ["Search statistics for the last {} stories (newest last)".format(len(stories))]
+    for stats in stories:
+        lines.append("{} - {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stats.started)), stats))
+    if len(stories) > 0:
+        total_time = sum(stats.wall_time for stats in stories)
+        total_parse_time = sum(stats.parse_time for stats in stories)
+        lines.append("")
+        lines.append("Average: {:.1f} s per story, {:.0f} nodes expanded, {:.0f} leaves scored, {:.0f} parses, {:.0%} of the time spent parsing".format(
+            total_time / len(stories), sum(stats.nodes_expanded for stats in stories) / len(stories),
+            sum(stats.leaves_scored for stats in stories) / len(stories), sum(stats.parses for stats in stories) / len(stories),
+            total_parse_time / total_time if total_time > 0 else 0))
+    with open(output_filename, 'w', encoding='utf-8') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return output_filename, cleanup
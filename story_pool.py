@@ -0,0 +1,110 @@
+import time
+import asyncio
+from collections import deque
+import story
+import story_workers
+from story_constants import *
+
+# most story requests are just 'short', 'medium' or 'long', so we keep a few of each told in advance and hand those out straight away
+# the pool is filled in the background, one story at a time and only while nobody is waiting on a story of their own
+# tts only changes how a story is split into messages, so the same pooled stories serve both
+# a pooled story is thrown out once it's too old, or once tobor has been fed enough since it was started that it's out of date
+class PooledStory:
+    def __init__(self, sentences, words_fed):
+        self.sentences = sentences
+        self.created = time.monotonic()
+        # how many words tobor had been fed (since he started up) when the story was started
+        self.words_fed = words_fed
+
+pools = {length: deque() for length in story.length_sentence_map}
+# how many words tobor has been fed since he started up
+words_fed = 0
+# how many stories are being told for people right now - the pool waits for these to finish before telling any of its own
+telling = 0
+# set whenever the pool might need topping up (or might be able to go back to it)
+wanted = None
+task = None
+
+# on_ready runs again every time the bot reconnects, so this only starts filling the pools the first time
+def init():
+    global wanted, task
+    if task is not None:
+        return
+    wanted = asyncio.Event()
+    task = asyncio.get_event_loop().create_task(fill_pools())
+
+def is_fresh(entry):
+    return time.monotonic() - entry.created < STORY_POOL_MAX_AGE and words_fed - entry.words_fed < STORY_POOL_FEED_WORDS
+
+def evict():
+    for pool in pools.values():
+        fresh = [entry for entry in pool if is_fresh(entry)]
+        if len(fresh) < len(pool):
+            pool.clear()
+            pool.extend(fresh)
+            wanted.set()
+
+# called whenever tobor is fed
+def fed(word_count):
+    global words_fed
+    words_fed += word_count
+    if wanted is not None:
+        evict()
+
+# returns the sentences of a pooled story of the given length, or None if there aren't any
+def take(length):
+    evict()
+    pool = pools[length]
+    if len(pool) == 0:
+        return None
+    wanted.set()
+    return pool.popleft().sentences
+
+# yields the sentences of a story - straight from the pool if there's one there, otherwise as the workers tell it (see story_workers.stream_story)
+# only stories told the default way are pooled
+async def tell(length, mode=DEFAULT_SEARCH_MODE, order=None):
+    global telling
+    sentences = None
+    if wanted is not None and mode == DEFAULT_SEARCH_MODE and order is None:
+        sentences = take(length)
+    if sentences is not None:
+        for sentence in sentences:
+            yield sentence
+        return
+    telling += 1
+    try:
+        async for sentence in story_workers.stream_story(length, mode, order):
+            yield sentence
+    finally:
+        telling -= 1
+        if wanted is not None:
+            wanted.set()
+
+async def fill_pools():
+    while True:
+        evict()
+        wanted.clear()
+        length = next((length for length, pool in pools.items() if len(pool) < STORY_POOL_SIZE), None)
+        if length is None or telling > 0 or len(story.word_bank) == 0:
+            # there's nothing to do (or we shouldn't do it now) - wait until a story is taken, someone's story is done, tobor is fed, or it's time to check for old stories
+            try:
+                await asyncio.wait_for(wanted.wait(), STORY_POOL_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        started_at = words_fed
+        try:
+            sentences = [sentence async for sentence in story_workers.stream_story(length)]
+        except Exception as e:
+            # e.g. the story timed out, or someone else's story did and the workers were restarted underneath us
+            print("Failed to tell a {} story for the pool: {}".format(length, repr(e)))
+            await asyncio.sleep(STORY_POOL_CHECK_INTERVAL)
+            continue
+        if sentences == [story.NO_DATA]:
+            # the bank has words, but nothing that can start a story - there's no point trying again until tobor is fed
+            try:
+                await asyncio.wait_for(wanted.wait(), STORY_POOL_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        pools[length].append(PooledStory(sentences, started_at))
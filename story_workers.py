@@ -0,0 +1,116 @@
+import asyncio
+import functools
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import story
+import grammar_parse
+import story_metrics
+from story_constants import *
+
+# story generation can take minutes of cpu, so we do it in a pool of worker processes instead of on the discord event loop
+# each worker loads the word bank and the spacy model once when it starts, so a story doesn't pay for those
+executor = None
+worker_count = STORY_WORKER_COUNT
+# set when the word bank on disk has changed since the workers loaded it
+stale = False
+# a process that owns the queues which carry sentences back from the workers while a story is being told (see stream_story)
+manager = None
+
+# this runs once in every worker process when it starts up
+# we load the spacy model here rather than when the first story needs it, so no story has to wait for it
+def init_worker():
+    story.init(read_only=True)
+    grammar_parse.get_nlp()
+
+# like story_pool.init, this is called every time the bot (re)connects - the workers are only started the first time
+def init(count=STORY_WORKER_COUNT):
+    global worker_count
+    if executor is not None:
+        return
+    worker_count = count
+    get_executor()
+
+def get_executor():
+    global executor, stale
+    if executor is not None and stale:
+        # the workers have an old copy of the word bank, so we let them finish what they're doing and start fresh ones
+        executor.shutdown(wait=False)
+        executor = None
+    if executor is None:
+        # spawn (rather than fork) gives every worker a clean process, which is also the only option on windows
+        context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=worker_count, mp_context=context, initializer=init_worker)
+        stale = False
+    return executor
+
+# called whenever tobor is fed, so that the next story is told by workers who know the new words
+def refresh():
+    global stale
+    stale = True
+
+def get_manager():
+    global manager
+    if manager is None:
+        manager = multiprocessing.get_context('spawn').Manager()
+    return manager
+
+# stops every worker, including any that are still busy - there's no way to cancel a single task once it's running
+# if only is given, the workers are only stopped if they're still that pool - a story that went wrong on an old pool
+# mustn't take down the fresh one everyone else's stories are running on
+def kill(only=None):
+    global executor
+    if executor is None or (only is not None and executor is not only):
+        return
+    for process in list(executor._processes.values()):
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+    executor = None
+
+# this runs in a worker - it puts every sentence of the story in the queue as it's finished, then None once the story is over
+# returns the search statistics for the story
+def stream_to_queue(length, mode, order, sentences):
+    try:
+        return story.stream_story(length, sentences.put, mode, order)
+    finally:
+        # even if the story fell over - otherwise whoever is reading would wait for the timeout
+        sentences.put(None)
+
+# tells a story in the worker pool and yields each sentence of it (as text) as soon as the worker has finished it
+# raises asyncio.TimeoutError if the whole story takes longer than timeout seconds - in that case the workers are restarted
+# if the worker falls over (or its process dies) the error is raised as soon as we notice, rather than when the time runs out
+async def stream_story(length, mode=DEFAULT_SEARCH_MODE, order=None, timeout=STORY_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    sentences = get_manager().Queue()
+    story_executor = get_executor()
+    task = loop.run_in_executor(story_executor, functools.partial(stream_to_queue, length, mode, order, sentences))
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print("Story ({}, {}) took more than {} seconds - restarting the story workers".format(length, mode, timeout))
+            task.cancel()
+            kill(story_executor)
+            raise asyncio.TimeoutError()
+        try:
+            # the queue can only be waited on by blocking, so we do that in a thread to keep the event loop free
+            # we don't wait long at a time, so a worker that died without telling the queue is noticed quickly
+            sentence = await loop.run_in_executor(None, functools.partial(sentences.get, timeout=min(remaining, STORY_QUEUE_POLL_INTERVAL)))
+        except queue.Empty:
+            if task.done():
+                # the worker always ends the story with None, so if it's done and there's nothing left, it never got that far
+                break
+            continue
+        if sentence is None:
+            break
+        yield sentence
+    # this is where any error from the worker comes out
+    try:
+        stats = await task
+    except BrokenProcessPool:
+        # a worker process died (or never started), so no more stories can go to this pool - the next one gets a fresh pool
+        kill(story_executor)
+        raise
+    story_metrics.record(stats)
@@ -1,10 +1,14 @@
 # https://realpython.com/how-to-make-a-discord-bot-python/#how-to-make-a-discord-bot-in-the-developer-portal
 import asyncio
+import functools
+import aiohttp
 import random
+import time
 import util
 import oiaht
 import interviews
 import context as ooc
+import story_metrics
 import struct
 import sys
 import discord
@@ -17,6 +21,8 @@ from util import get_channel_id_from_mention, get_guild_id
 # TODO: story relies on spacy, which is currently broken due to a CUDA version mismatch
 if struct.calcsize("P") * 8 == 64 and False:
     import story
+    import story_workers
+    import story_pool
     X64 = True
 else:
     X64 = False
@@ -77,6 +83,8 @@ async def on_ready():
     interviews.init()
     if X64:
         story.init()
+        story_workers.init()
+        story_pool.init()
 
 @bot.event
 async def on_message(message):
@@ -98,11 +106,24 @@ async def tell_story(context: commands.Context, *args):
         return
 
     use_tts = 'tts' in args
+    # the search mode (e.g. 'beam') can be given anywhere in the arguments
+    modes = [x for x in args if x in story.search_mode_map]
+    mode = modes[0] if any(modes) else story.DEFAULT_SEARCH_MODE
+    # so can the chain length, as 'order=<number>'
+    orders = [x for x in args if x.startswith('order=')]
+    order = None
+    if any(orders):
+        try:
+            order = int(orders[0][len('order='):])
+        except ValueError:
+            order = 0
+        if order < 1 or order > story.MAX_CHAIN_LENGTH:
+            await context.send(f"I can only tell stories with an order between 1 and {story.MAX_CHAIN_LENGTH}.")
+            return
+    args = [x for x in args if x != 'tts' and x not in story.search_mode_map and not x.startswith('order=')]
     if len(args) == 0:
         length = 'medium'
     else:
-        if args[0] == 'tts' and len(args) > 1:
-            args = args[1:]
         length = args[0]
         if length not in ['short', 'medium', 'long']:
             await context.send(f"I don't know how to tell a {length} story.")
@@ -113,9 +134,33 @@ async def tell_story(context: commands.Context, *args):
     else:
         chunk_size = 1900
 
-    story_chunks = story.generate_story(length, chunk_size)
-    for chunk in story_chunks:
-        await context.send(chunk, tts=use_tts)
+    # the story is sent while tobor is still telling it - each sentence shows up as soon as it's finished
+    # without tts, the last message is edited to add each sentence until it's full, then we start a new one
+    # tts can't read out an edit, so there we only send a chunk once it's full
+    packer = story.ChunkPacker(chunk_size)
+    message = None
+
+    async def send_chunk(chunk, is_full):
+        nonlocal message
+        if len(chunk) == 0:
+            return
+        if message is not None:
+            await message.edit(content=chunk)
+        elif is_full or not use_tts:
+            message = await context.send(chunk, tts=use_tts)
+        if is_full:
+            message = None
+
+    try:
+        async for sentence in story_pool.tell(length, mode, order):
+            for chunk in packer.add(sentence.split()):
+                await send_chunk(chunk, True)
+            await send_chunk(packer.current(), False)
+    except asyncio.TimeoutError:
+        await context.send("Tobor got lost in his own story and had to give up")
+        return
+    for chunk in packer.finish():
+        await send_chunk(chunk, True)
 
 @bot.command(name='quote', description="Provides a random quote")
 async def select_quote(interaction: discord.Interaction):
@@ -217,25 +262,62 @@ async def feed_story_generator(context: commands.Context, *, args):
         return
     if args == 'file':
         # we've been given a text file
-        try:
-            # we read the attached file with the encoding utf-8
-            msg = await context.message.attachments[0].read()
-            args = msg.decode('utf-8')
-        except:
-            await context.send("Failed to read attachment as utf-8 text file")
+        if len(context.message.attachments) == 0:
+            await context.send("You have to attach the file you want me to eat")
             return
-    story.feed_generator(args)
-    await context.send("Mmm, tasty")
+        # we read the attached file with the encoding utf-8, a chunk at a time
+        word_count, complete = await feed_attachment(context, context.message.attachments[0])
+    else:
+        # the journal write (and now and then a compaction of the whole bank) would hold up everything else on the event loop
+        word_count, complete = await asyncio.get_running_loop().run_in_executor(None, story.feed_generator, args), True
+    if word_count > 0:
+        story_workers.refresh()
+        # pooled stories might be out of date now
+        story_pool.fed(word_count)
+    if complete:
+        await context.send("Mmm, tasty")
+    else:
+        await context.send(f"Failed to read attachment as utf-8 text file - I only ate the first {word_count} words")
+
+# streams an attached file into tobor's word bank, so a whole book never has to be in memory at once
+# the counting happens on another thread, so tobor can keep answering commands while he eats
+# returns how many words tobor ate, and whether that was the whole file
+# if the download fails or the file isn't utf-8 partway through, the words before that have already gone into the bank, so they're kept
+async def feed_attachment(context: commands.Context, attachment: discord.Attachment):
+    loop = asyncio.get_running_loop()
+    stream = story.FeedStream()
+    progress = await context.send(f"Nibbling on {attachment.filename}...")
+    bytes_read = 0
+    last_report = time.monotonic()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(story.FEED_CHUNK_SIZE):
+                    await loop.run_in_executor(None, stream.feed_bytes, chunk)
+                    bytes_read += len(chunk)
+                    if time.monotonic() - last_report > story.FEED_PROGRESS_INTERVAL:
+                        last_report = time.monotonic()
+                        percent = 100 * bytes_read // max(attachment.size, 1)
+                        await progress.edit(content=f"Nibbling on {attachment.filename}... {percent}% ({stream.word_count} words)")
+    except (UnicodeDecodeError, aiohttp.ClientError):
+        await loop.run_in_executor(None, functools.partial(stream.finish, complete=False))
+        await progress.edit(content=f"Choked on {attachment.filename} after {stream.word_count} words")
+        return stream.word_count, False
+    await loop.run_in_executor(None, stream.finish)
+    await progress.edit(content=f"Ate all {stream.word_count} words of {attachment.filename}")
+    return stream.word_count, True
 
 @bot.command(name='nextroll', help="Shows the next OiaHT roll occurrence")
 async def get_oiaht_roll_time(context: commands.Context, *args):
     time, eta = oiaht.get_next_roll_time()
     await context.send(f"The next roll will occur in {eta} at {time}")
 
-@bot.command(name='metrics', help="Display metrics relating to the OiaHT ruleset")
+@bot.command(name='metrics', help="Display metrics relating to the OiaHT ruleset ('distro') or recent stories ('story')")
 async def get_oiaht_metrics(context: commands.Context, *args):
     rule_map = {
-        "distro": oiaht.get_rule_distribution_plot
+        "distro": oiaht.get_rule_distribution_plot,
+        "story": story_metrics.get_story_metrics_report
     }
     if (len(args) == 0):
         await context.send(f"You must specify a metric type. Available options are:\n{', '.join(rule_map.keys())}")
@@ -244,7 +326,7 @@ async def get_oiaht_metrics(context: commands.Context, *args):
     if (metricType in rule_map):
         result = rule_map[metricType](args)
         if not result:
-            await context.send(f"Make sure you enter a number for bin size")
+            await context.send(f"Make sure you enter a number for {'the story count' if metricType == 'story' else 'bin size'}")
             return
         output, cleanupCB = result
     else:
@@ -305,4 +387,7 @@ async def build_random_teams(context: commands.Context, *args):
 if __name__ == "__main__":
     print("Starting Tobor")
     bot.run(token)
+    if X64:
+        # everything tobor has been fed goes into the word bank file, so the next start doesn't have to replay it
+        story.compact_bank()
     print("Closing Tobor")
\ No newline at end of file
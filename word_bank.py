@@ -0,0 +1,628 @@
+import os
+import mmap
+import random
+import json
+import zlib
+import struct
+import numpy as np
+from story_constants import ALIAS_TABLE_CACHE_SIZE
+
+# the on-disk word bank format - a fixed header followed by the arrays, each starting on an 8-byte boundary
+# header: magic, format version, n, word count, vocabulary blob size, key count, successor count, last journal record folded in,
+#         sentence start key count
+# sections: word offsets (uint64, word count + 1), vocabulary blob (sorted utf-8 words), keys (big-endian uint32, key count * n),
+#           key offsets (int64, key count + 1), successors (uint32), counts (uint32),
+#           sentence start rows (uint64), running total of the sentence start keys' counts (uint64)
+# everything can be used straight out of a memory map, so opening a bank costs the same no matter how big it is
+BANK_MAGIC = b'TOBORWB\0'
+BANK_VERSION = 3
+BANK_HEADER = struct.Struct('<8sIIQQQQQQ')
+
+# tobor's markov chain, stored compactly
+# every word is swapped for an integer id (id 0 is None, which marks the end of a text), and the rest of the vocabulary is kept in sorted order
+# the keys (n words each) are packed into one sorted array of ids, so we can binary search for a key
+# the words which can follow each key are stored CSR-style: the successors of key i are successors[offsets[i]:offsets[i + 1]], with matching counts
+# feeding tobor doesn't touch those arrays - new counts go into 'pending' until the bank is compacted
+# to the story code it looks like the old dict of dicts: 'key in bank', 'bank[key]' (a dict of word -> count), len(bank) and bank.keys()
+# it also keeps an index of the keys a story can start with, so picking the start of a story is a single random draw
+class WordBank:
+    def __init__(self, n, vocab=None, keys=None, offsets=None, successors=None, counts=None, mapping=None, journal_seq=0,
+                 start_rows=None, start_totals=None):
+        self.n = n
+        self.vocab = vocab if vocab is not None else Vocabulary([])
+        # keys are stored big-endian, so that comparing the raw bytes of two keys orders them the same as comparing their ids
+        self.keys_array = keys if keys is not None else np.zeros((0, n), dtype='>u4')
+        self.key_index = as_key_index(self.keys_array)
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.successors = successors if successors is not None else np.zeros(0, dtype=np.uint32)
+        self.counts = counts if counts is not None else np.zeros(0, dtype=np.uint32)
+        # key -> {tail: count} for everything fed since the last compaction
+        self.pending = {}
+        # the memory map the arrays live in, if they came from a file
+        self.mapping = mapping
+        # the sequence number of the last journal record which is included in the saved bank
+        self.journal_seq = journal_seq
+        # the rows of the keys a story can start with, and a running total of how often those keys show up (for weighted draws)
+        if start_rows is None:
+            start_rows, start_totals = find_start_rows(self.vocab, self.keys_array, self.offsets, self.counts)
+        self.start_rows = start_rows
+        self.start_totals = start_totals
+        # start keys fed since the last compaction - new_start_keys are the ones which aren't in the packed arrays yet
+        # and start_draws holds one entry for every time any start key was fed, so a random entry is a weighted draw
+        self.new_start_keys = []
+        self.start_draws = []
+        # key -> (successors, probabilities, aliases) for weighted successor draws - built when first needed, and dropped when the key is fed
+        self.alias_tables = {}
+        # how many times each word id has followed any key in the packed arrays, and the total of those - built when first needed (see word_frequency)
+        self.word_totals = None
+        self.word_total = 0
+        # the same for everything fed since the last compaction, by word - kept up to date as we're fed
+        self.pending_word_totals = {}
+        self.pending_word_total = 0
+
+    # returns the row of the key in the packed arrays, or -1 if it isn't there
+    def find_key(self, key):
+        ids = []
+        for word in key:
+            word_id = self.vocab.id_of(word)
+            if word_id < 0:
+                return -1
+            ids.append(word_id)
+        query = as_key_index(np.array([ids], dtype='>u4'))
+        row = int(np.searchsorted(self.key_index, query)[0])
+        if row < len(self.key_index) and self.key_index[row] == query[0]:
+            return row
+        return -1
+
+    def __contains__(self, key):
+        return key in self.pending or self.find_key(key) >= 0
+
+    def __getitem__(self, key):
+        successors = self.get(key)
+        if successors is None:
+            raise KeyError(key)
+        return successors
+
+    # returns a dict of every word which can follow the key and how many times it has, or default if nothing follows it
+    def get(self, key, default=None):
+        row = self.find_key(key)
+        if row < 0 and key not in self.pending:
+            return default
+        successors = {}
+        if row >= 0:
+            start, end = self.offsets[row], self.offsets[row + 1]
+            for word_id, count in zip(self.successors[start:end].tolist(), self.counts[start:end].tolist()):
+                successors[self.vocab[word_id]] = count
+        for word, count in self.pending.get(key, {}).items():
+            successors[word] = successors.get(word, 0) + count
+        return successors
+
+    def __len__(self):
+        new_keys = sum(1 for key in self.pending if self.find_key(key) < 0)
+        return len(self.key_index) + new_keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        keys = [tuple(self.vocab[i] for i in row) for row in self.keys_array.tolist()]
+        keys += [key for key in self.pending if self.find_key(key) < 0]
+        return keys
+
+    def items(self):
+        for key in self.keys():
+            yield key, self.get(key)
+
+    # records that tail followed key (count more times)
+    # get_word_combos gives back a short key at the very end of a text - stories only ever look up keys of length n, so we leave those out
+    def increment(self, key, tail, count=1):
+        if len(key) != self.n:
+            return
+        self.alias_tables.pop(key, None)
+        if is_start_key(key):
+            if key not in self.pending and self.find_key(key) < 0:
+                self.new_start_keys.append(key)
+            self.start_draws.extend([key] * count)
+        successors = self.pending.setdefault(key, {})
+        successors[tail] = successors.get(tail, 0) + count
+        self.pending_word_totals[tail] = self.pending_word_totals.get(tail, 0) + count
+        self.pending_word_total += count
+
+    # returns a random word which can follow key, picked in proportion to how often it has followed it (or None if nothing follows the key)
+    # this is a single draw from the key's alias table, no matter how many successors it has
+    def sample_successor(self, key):
+        if key not in self.alias_tables:
+            successors = self.get(key)
+            if successors is None:
+                return None
+            if len(self.alias_tables) >= ALIAS_TABLE_CACHE_SIZE:
+                self.alias_tables.clear()
+            words = list(successors.keys())
+            self.alias_tables[key] = (words,) + build_alias_table(list(successors.values()))
+        words, probabilities, aliases = self.alias_tables[key]
+        choice = random.randrange(len(words))
+        if random.random() >= probabilities[choice]:
+            choice = aliases[choice]
+        return words[choice]
+
+    # makes up to 'count' weighted draws and returns the distinct words, in the order they were first drawn
+    # common successors are very likely to be picked, and rare ones sometimes are
+    # a key nothing has followed gives an empty list
+    def sample_successors(self, key, count):
+        if key not in self.alias_tables and len(self.get(key, {})) == 0:
+            return []
+        samples = []
+        for _ in range(count):
+            word = self.sample_successor(key)
+            if word not in samples:
+                samples.append(word)
+        return samples
+
+    # returns how often the word shows up in everything tobor has been fed (including since the last compaction),
+    # as a share of all words - smoothed, so it's never 0
+    def word_frequency(self, word):
+        if self.word_totals is None:
+            self.word_totals = np.bincount(self.successors, weights=self.counts, minlength=len(self.vocab))
+            self.word_total = float(self.word_totals.sum())
+        word_id = self.vocab.id_of(word)
+        count = (self.word_totals[word_id] if word_id >= 0 else 0) + self.pending_word_totals.get(word, 0)
+        return (count + 1) / (self.word_total + self.pending_word_total + len(self.vocab))
+
+    def key_at(self, row):
+        return tuple(self.vocab[i] for i in self.keys_array[row].tolist())
+
+    # picks a random key which a story can start with, or None if there aren't any
+    # weighted draws pick keys in proportion to how often they show up in everything tobor has been fed
+    def random_start_key(self, weighted=False):
+        packed_count = len(self.start_rows)
+        if not weighted:
+            total = packed_count + len(self.new_start_keys)
+            if total == 0:
+                return None
+            choice = random.randrange(total)
+            if choice < packed_count:
+                return self.key_at(int(self.start_rows[choice]))
+            return self.new_start_keys[choice - packed_count]
+        packed_total = int(self.start_totals[-1]) if packed_count > 0 else 0
+        total = packed_total + len(self.start_draws)
+        if total == 0:
+            return None
+        choice = random.randrange(total)
+        if choice < packed_total:
+            # the first key whose running total goes past our choice
+            return self.key_at(int(self.start_rows[np.searchsorted(self.start_totals, choice, side='right')]))
+        return self.start_draws[choice - packed_total]
+
+    # folds everything that has been fed since the last compaction into the packed arrays
+    def compact(self):
+        if not any(self.pending):
+            return
+        n = self.n
+        # the new vocabulary is the old one plus any new words, sorted again - so every id might change
+        new_words = set()
+        for key, successors in self.pending.items():
+            new_words.update(key)
+            new_words.update(successors.keys())
+        new_words.discard(None)
+        old_words = list(self.vocab)
+        vocab = Vocabulary(sorted(new_words.union(old_words[1:])))
+        word_ids = vocab.word_ids
+        remap = np.array([word_ids[word] for word in old_words], dtype=np.uint32)
+
+        # every (key, tail) pair we have, as rows of ids - first the ones already packed...
+        key_counts = np.diff(self.offsets)
+        old_rows = np.empty((len(self.successors), n + 1), dtype='>u4')
+        old_rows[:, :n] = np.repeat(remap[self.keys_array.astype(np.uint32)], key_counts, axis=0)
+        old_rows[:, n] = remap[self.successors]
+        # ...then the ones fed since
+        new_rows = []
+        new_counts = []
+        for key, successors in self.pending.items():
+            key_ids = [word_ids[word] for word in key]
+            for tail, count in successors.items():
+                new_rows.append(key_ids + [word_ids[tail]])
+                new_counts.append(count)
+        rows = np.concatenate([old_rows, np.array(new_rows, dtype='>u4').reshape(-1, n + 1)])
+        counts = np.concatenate([self.counts.astype(np.int64), np.array(new_counts, dtype=np.int64)])
+
+        self.set_packed(vocab, *pack_rows(rows, counts, n))
+
+    # replaces the packed arrays - anything pending is assumed to be included in them
+    def set_packed(self, vocab, keys, offsets, successors, counts):
+        self.vocab = vocab
+        self.keys_array = keys
+        self.key_index = as_key_index(keys)
+        self.offsets = offsets
+        self.successors = successors
+        self.counts = counts
+        self.pending = {}
+        self.start_rows, self.start_totals = find_start_rows(self.vocab, self.keys_array, self.offsets, self.counts)
+        self.new_start_keys = []
+        self.start_draws = []
+        self.word_totals = None
+        self.pending_word_totals = {}
+        self.pending_word_total = 0
+
+    # writes the bank out in the memory-mappable format, then switches over to reading it from the new file
+    def save(self, path):
+        self.compact()
+        words = [word.encode('utf-8') for word in list(self.vocab)[1:]]
+        word_offsets = np.zeros(len(words) + 1, dtype=np.uint64)
+        word_offsets[1:] = np.cumsum([len(word) for word in words])
+        blob = b''.join(words)
+        # we write to a temporary file first so that a crash can't leave a half-written bank behind
+        # path mustn't be a bank that's open anywhere - see BankJournal.compact for how we avoid that
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as fp:
+            fp.write(BANK_HEADER.pack(BANK_MAGIC, BANK_VERSION, self.n, len(words), len(blob), len(self.key_index), len(self.successors),
+                                      self.journal_seq, len(self.start_rows)))
+            for section in [word_offsets.tobytes(), blob, np.ascontiguousarray(self.keys_array, dtype='>u4').tobytes(),
+                            self.offsets.astype(np.int64).tobytes(), self.successors.astype(np.uint32).tobytes(),
+                            self.counts.astype(np.uint32).tobytes(), self.start_rows.astype(np.uint64).tobytes(),
+                            self.start_totals.astype(np.uint64).tobytes()]:
+                fp.write(section)
+                fp.write(b'\0' * padding(len(section)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+        # anyone else who opens the file shares the same pages, so we let go of our own copy of the arrays
+        opened = WordBank.open(path)
+        self.vocab = opened.vocab
+        self.keys_array = opened.keys_array
+        self.key_index = opened.key_index
+        self.offsets = opened.offsets
+        self.successors = opened.successors
+        self.counts = opened.counts
+        self.start_rows = opened.start_rows
+        self.start_totals = opened.start_totals
+        self.mapping = opened.mapping
+
+    # opens a saved bank without reading it - the arrays are views straight into the memory-mapped file
+    @staticmethod
+    def open(path):
+        with open(path, 'rb') as fp:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, word_count, blob_size, key_count, successor_count, journal_seq, start_count = BANK_HEADER.unpack_from(mapping, 0)
+        if magic != BANK_MAGIC or version != BANK_VERSION:
+            raise ValueError("{} is not a version {} word bank".format(path, BANK_VERSION))
+        position = BANK_HEADER.size
+
+        def section(dtype, count):
+            nonlocal position
+            array = np.frombuffer(mapping, dtype=dtype, count=count, offset=position)
+            position += array.nbytes + padding(array.nbytes)
+            return array
+
+        word_offsets = section(np.uint64, word_count + 1)
+        blob_start = position
+        position += blob_size + padding(blob_size)
+        vocab = MappedVocabulary(mapping, word_offsets, blob_start)
+        keys = section('>u4', key_count * n).reshape(key_count, n)
+        offsets = section(np.int64, key_count + 1)
+        successors = section(np.uint32, successor_count)
+        counts = section(np.uint32, successor_count)
+        start_rows = section(np.uint64, start_count)
+        start_totals = section(np.uint64, start_count)
+        return WordBank(n, vocab, keys, offsets, successors, counts, mapping, journal_seq, start_rows, start_totals)
+
+    # builds a compact bank out of the old dict of dicts ({key: {tail: count}})
+    @staticmethod
+    def from_dict(bank, n):
+        word_bank = WordBank(n)
+        for key, successors in bank.items():
+            for tail, count in successors.items():
+                word_bank.increment(key, tail, count)
+        word_bank.compact()
+        return word_bank
+
+    # builds a bank from an n-gram count table (see count_ngrams)
+    @staticmethod
+    def from_ngram_counts(table, n):
+        words, rows, counts = table
+        return WordBank(n, Vocabulary(words), *pack_rows(rows, counts, n))
+
+    # builds a bank with the same counts as feeding it each of the texts in turn, but all at once
+    @staticmethod
+    def from_texts(texts, n):
+        return WordBank.from_ngram_counts(count_ngrams(texts, n), n)
+
+# an append-only record of everything fed to a bank since it was last saved
+# each feed appends one record (its n-gram counts), so feeding costs the size of the text rather than the size of the bank
+# a record is: payload length, crc32 of the payload, then the payload - json of [sequence number, [[key, tail, count], ...]]
+# if tobor dies halfway through writing a record, the length or checksum won't match and replay stops just before it
+# sequence numbers keep going up across compactions - the bank remembers the last one it includes, so nothing is ever counted twice
+JOURNAL_RECORD_HEADER = struct.Struct('<II')
+
+class BankJournal:
+    def __init__(self, path):
+        self.path = path
+        self.next_seq = 1
+        # how much of the file holds complete records
+        self.valid_size = 0
+
+    # adds every complete record the bank doesn't already include to the bank's pending counts
+    # returns how many records were applied
+    def replay(self, bank):
+        self.next_seq = bank.journal_seq + 1
+        self.valid_size = 0
+        if not os.path.exists(self.path):
+            return 0
+        applied = 0
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        position = 0
+        while position + JOURNAL_RECORD_HEADER.size <= len(data):
+            length, checksum = JOURNAL_RECORD_HEADER.unpack_from(data, position)
+            start = position + JOURNAL_RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                # a record that was never finished - everything from here on is garbage
+                print("Ignoring a damaged record at the end of journal {}".format(self.path))
+                break
+            seq, deltas = json.loads(payload.decode('utf-8'))
+            if seq > bank.journal_seq:
+                for key, tail, count in deltas:
+                    bank.increment(tuple(key), tail, count)
+                applied += 1
+            self.next_seq = max(self.next_seq, seq + 1)
+            position = start + length
+        self.valid_size = position
+        return applied
+
+    # cuts off a record which was only partly written, so new records don't end up after it
+    # only the process that writes to the journal should do this
+    def repair(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.valid_size:
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(self.valid_size)
+
+    # writes one record of (key, tail, count) deltas and makes sure it's on disk before returning
+    def append(self, deltas):
+        payload = json.dumps([self.next_seq, [[list(key), tail, count] for key, tail, count in deltas]]).encode('utf-8')
+        with open(self.path, 'ab') as fp:
+            fp.write(JOURNAL_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.valid_size += JOURNAL_RECORD_HEADER.size + len(payload)
+        self.next_seq += 1
+        return self.next_seq - 1
+
+    def size(self):
+        return self.valid_size
+
+    # folds the journal into the bank: the bank is saved as a new generation (including every record so far), then the journal is emptied
+    # if we crash between the two, the saved bank already knows the records' sequence numbers, so replay skips them
+    # force saves the bank even if nothing has been fed since it was last saved (e.g. it was just rebuilt)
+    def compact(self, bank, bank_path, force=False):
+        if not force and self.valid_size == 0 and not any(bank.pending):
+            return
+        bank.journal_seq = self.next_seq - 1
+        bank.save(next_bank(bank_path))
+        with open(self.path, 'wb'):
+            pass
+        self.valid_size = 0
+        remove_old_banks(bank_path)
+
+# a bank file can't be replaced while it's memory mapped - windows won't allow it, and the story workers have it mapped too
+# so a bank is saved to a new file every time: 'tobor-bank-3.bin' is saved as tobor-bank-3.1.bin, then tobor-bank-3.2.bin and so on,
+# and opening the bank means opening the newest of them (latest_bank) - the plain name counts as generation 0
+def bank_generations(path):
+    root, extension = os.path.splitext(path)
+    folder = os.path.dirname(path)
+    prefix = os.path.basename(root) + '.'
+    generations = [(0, path)] if os.path.exists(path) else []
+    for name in os.listdir(folder or '.'):
+        number = name[len(prefix):len(name) - len(extension)]
+        if name.startswith(prefix) and name.endswith(extension) and number.isdigit():
+            generations.append((int(number), os.path.join(folder, name)))
+    return sorted(generations)
+
+# returns the file the newest generation of the bank is in, or None if it has never been saved
+def latest_bank(path):
+    generations = bank_generations(path)
+    return generations[-1][1] if len(generations) > 0 else None
+
+def next_bank(path):
+    generations = bank_generations(path)
+    root, extension = os.path.splitext(path)
+    return "{}.{}{}".format(root, generations[-1][0] + 1 if len(generations) > 0 else 1, extension)
+
+# deletes every generation but the newest - any that are still mapped somewhere (on windows) are left for the next time
+def remove_old_banks(path):
+    for _, name in bank_generations(path)[:-1]:
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+# builds a walker alias table for drawing indices in proportion to weights
+# each index i gets a slot, which is kept with probability probabilities[i] and otherwise hands over to aliases[i]
+def build_alias_table(weights):
+    count = len(weights)
+    total = float(sum(weights))
+    scaled = [weight * count / total for weight in weights]
+    probabilities = [1.0] * count
+    aliases = list(range(count))
+    small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+    large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+    while len(small) > 0 and len(large) > 0:
+        less = small.pop()
+        more = large.pop()
+        # the rare index keeps its share of the slot, and the common one fills in the rest
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    # whatever is left over (only rounding errors) keeps its whole slot
+    return probabilities, aliases
+
+# a story has to start with a proper word with a capital letter - not punctuation, and not the end of a text
+def is_start_key(key):
+    word = key[0]
+    return word is not None and word.isalpha() and not word.islower()
+
+# returns the rows of every packed key which a story can start with, and the running total of those keys' counts
+def find_start_rows(vocab, keys, offsets, counts):
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+    first_ids = keys[:, 0].astype(np.int64)
+    # we only need to look at each distinct first word once
+    first_words = np.unique(first_ids)
+    start_words = first_words[[is_start_key((vocab[int(word_id)],)) for word_id in first_words]]
+    start_rows = np.flatnonzero(np.isin(first_ids, start_words)).astype(np.uint64)
+    # how many times each key shows up is the sum of its successors' counts
+    key_totals = np.add.reduceat(counts.astype(np.uint64), offsets[:-1])
+    return start_rows, np.cumsum(key_totals[start_rows]).astype(np.uint64)
+
+# views each packed key (a row of big-endian ids) as a single blob of bytes, which numpy can sort and binary search
+def as_key_index(keys):
+    keys = np.ascontiguousarray(keys, dtype='>u4')
+    return keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+
+# takes rows of (key ids..., tail id) with a count for each row (rows may repeat)
+# returns the packed keys, offsets, successors and counts, with repeated rows added together
+def pack_rows(rows, counts, n):
+    if len(rows) == 0:
+        return np.zeros((0, n), dtype='>u4'), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+    unique_rows, inverse = np.unique(as_key_index(rows), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(unique_rows)).astype(np.uint32)
+    unique_rows = unique_rows.view('>u4').reshape(-1, n + 1)
+    # the rows are sorted, so every key's successors are next to each other - a new key starts wherever the key part changes
+    key_starts = np.ones(len(unique_rows), dtype=bool)
+    key_starts[1:] = np.any(unique_rows[1:, :n] != unique_rows[:-1, :n], axis=1)
+    starts = np.flatnonzero(key_starts)
+    keys = np.ascontiguousarray(unique_rows[starts, :n])
+    offsets = np.append(starts, len(unique_rows)).astype(np.int64)
+    successors = unique_rows[:, n].astype(np.uint32)
+    return keys, offsets, successors, counts
+
+# counts every word combo in a batch of texts at once, rather than updating a dict for each one like feeding does
+# the counts come out exactly as if each text had been fed on its own (see story_util.get_word_combos and WordBank.increment):
+# that includes the combos padded with None at the end of each text, and leaves out the ones whose key isn't n words long
+# returns an n-gram count table - (words, rows, counts), where words are the sorted vocabulary (without None, which is id 0),
+# rows are the distinct (key ids..., tail id) combos as big-endian ids, and counts is how many times each row showed up
+def count_ngrams(texts, n):
+    word_ids = {None: 0}
+    ids = []
+    starts = []
+    lengths = []
+    for text in texts:
+        words = text.split()
+        if len(words) == 0:
+            continue
+        starts.append(len(ids))
+        lengths.append(len(words))
+        ids.extend([word_ids.setdefault(word, len(word_ids)) for word in words])
+        # the end of every text reads as two Nones: the last full key is followed by None, and the key after it ends with a None
+        ids.extend([0, 0])
+    local_words = list(word_ids)
+    words = sorted(local_words[1:])
+    if len(ids) == 0:
+        return words, np.zeros((0, n + 1), dtype='>u4'), np.zeros(0, dtype=np.int64)
+    # we gave out ids in the order we first saw each word, but the bank wants them in sorted order
+    remap = np.zeros(len(local_words), dtype=np.uint32)
+    remap[[word_ids[word] for word in words]] = np.arange(1, len(words) + 1, dtype=np.uint32)
+    corpus = remap[np.array(ids + [0] * n, dtype=np.int64)]
+
+    # every window of n + 1 words is a (key, tail) combo - but only some of them are combos feeding the text would count
+    # a text of k words starting at s gives the windows starting from s up to s + k - n (ending in a None tail), plus s + k - n + 1 (a key ending in None)
+    # and a window can never start on the Nones themselves
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
+    lasts = starts + np.minimum(lengths - n + 1, lengths - 1)
+    has_windows = lasts >= starts
+    marks = np.zeros(len(corpus) + 1, dtype=np.int64)
+    np.add.at(marks, starts[has_windows], 1)
+    np.add.at(marks, lasts[has_windows] + 1, -1)
+    keep = np.cumsum(marks[:-n - 1]) > 0
+    windows = np.lib.stride_tricks.sliding_window_view(corpus, n + 1)[keep]
+
+    rows = np.ascontiguousarray(windows, dtype='>u4')
+    unique_rows, inverse = np.unique(as_key_index(rows), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), minlength=len(unique_rows)).astype(np.int64)
+    return words, unique_rows.view('>u4').reshape(-1, n + 1), counts
+
+# adds several n-gram count tables together - their vocabularies don't need to match
+def merge_ngram_counts(tables, n):
+    words = sorted(set().union(*[table[0] for table in tables]))
+    word_ids = {word: i + 1 for i, word in enumerate(words)}
+    all_rows = []
+    all_counts = []
+    for table_words, rows, counts in tables:
+        remap = np.array([0] + [word_ids[word] for word in table_words], dtype=np.uint32)
+        all_rows.append(remap[rows.astype(np.uint32)])
+        all_counts.append(counts.astype(np.int64))
+    rows = np.ascontiguousarray(np.concatenate(all_rows), dtype='>u4').reshape(-1, n + 1)
+    if len(rows) == 0:
+        return words, rows, np.zeros(0, dtype=np.int64)
+    unique_rows, inverse = np.unique(as_key_index(rows), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate(all_counts), minlength=len(unique_rows)).astype(np.int64)
+    return words, unique_rows.view('>u4').reshape(-1, n + 1), counts
+
+# how many bytes of padding to put after a section of the given size so the next one starts on an 8-byte boundary
+def padding(size):
+    return -size % 8
+
+# the words in a bank - id 0 is always None, and the rest are in sorted order
+# maps ids to words (vocab[i]) and words to ids (vocab.id_of(word), which is -1 for a word we don't know)
+class Vocabulary:
+    def __init__(self, words):
+        self.words = [None] + list(words)
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+
+    def __getitem__(self, word_id):
+        return self.words[word_id]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def id_of(self, word):
+        return self.word_ids.get(word, -1)
+
+# the same thing, but read in place from a memory-mapped bank file
+# words are decoded when they're asked for, and looked up by binary search (the blob is sorted, and utf-8 bytes sort the same as the words do)
+class MappedVocabulary:
+    def __init__(self, mapping, word_offsets, blob_start):
+        self.mapping = mapping
+        self.word_offsets = word_offsets
+        self.blob_start = blob_start
+        # the words a story uses come up over and over, so we remember the ones we've already searched for
+        self.known_ids = {None: 0}
+
+    def word_bytes(self, word_id):
+        start = self.blob_start + int(self.word_offsets[word_id - 1])
+        end = self.blob_start + int(self.word_offsets[word_id])
+        return self.mapping[start:end]
+
+    def __getitem__(self, word_id):
+        if word_id == 0:
+            return None
+        return self.word_bytes(word_id).decode('utf-8')
+
+    def __len__(self):
+        return len(self.word_offsets)
+
+    def __iter__(self):
+        for word_id in range(len(self)):
+            yield self[word_id]
+
+    def id_of(self, word):
+        if word in self.known_ids:
+            return self.known_ids[word]
+        target = word.encode('utf-8')
+        low, high = 1, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.word_bytes(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        word_id = low if low < len(self) and self.word_bytes(low) == target else -1
+        self.known_ids[word] = word_id
+        return word_id